@@ -1,4 +1,5 @@
 import google.generativeai as genai
+import gemini_client
 import os
 import json
 import time
@@ -7,74 +8,105 @@ import hashlib
 import argparse
 import pdb
 import atexit
-import functools
+import threading
 from pathlib import Path
+from pypdf import PdfReader, PdfWriter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from scraper import firecrawl, jina, magic_markdownify, readability_markdownify, download_pdf, download_file, extract_markdown_images, write_flie
+from google.api_core.exceptions import NotFound
+from gemini_client import gemini_call, CachedPrefixModel, create_context_cache, extend_context_cache, delete_context_cache
+from scraper import firecrawl, jina, magic_markdownify, readability_markdownify, download_pdf, extract_markdown_images, write_flie
 from tokens import tokens
 from subtitle_downloader import download_captions
-from sqlalchemy import create_engine, Column, String, DateTime, Text
+from images import download_images
+from cache import utcnow, file_sha256, get_uploaded_file, put_uploaded_file, drop_uploaded_file
+from cache import RESPONSE_CACHE, response_key, get_cached_response, put_cached_response
+from search import create_fts, index_conversation, unindex_conversation, index_messages, unindex_messages, is_searchable, search, encode_cursor, decode_cursor
+from storage import EngineRegistry
+from metrics import span, set_trace_labels, propagate, start_trace, end_trace
+from sqlalchemy import Column, String, DateTime, Text, Integer, Index, or_, and_, text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 Base = declarative_base()
-ENGINES = {v: create_engine(f'sqlite:///db/{v}.db') for v in tokens.values()}
-ENGINES["summarizer"] = create_engine("sqlite:///db/summarizer.db") # fallback
-
-def set_gemini_proxy(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        GEMINI_PROXY = os.getenv('GEMINI_PROXY', '')
-        if GEMINI_PROXY:
-            http_proxy = os.environ.pop('http_proxy', '')
-            https_proxy = os.environ.pop('https_proxy', '')
-
-            os.environ['http_proxy'] = os.getenv('GEMINI_PROXY', '')
-            os.environ['https_proxy'] = os.getenv('GEMINI_PROXY', '')
-
-        result = func(*args, **kwargs)
-
-        if GEMINI_PROXY:
-            os.environ['http_proxy'] = http_proxy
-            os.environ['https_proxy'] = https_proxy
-        return result
-    return wrapper
-
+ENGINES = EngineRegistry('sqlite:///db/{name}.db', setup=lambda engine: create_schema(engine))
+DBS = set(tokens.values()) | {"summarizer"} # summarizer is the fallback
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 4))
+# text sources up to this size go into the first turn as text parts instead of through the File API, 0 turns it off
+INLINE_TEXT_MAX_BYTES = int(os.getenv('INLINE_TEXT_MAX_BYTES', 64 * 1024))
+ACTIVATION_TIMEOUT = int(os.getenv('ACTIVATION_TIMEOUT', 600))
+SCRAPE_WORKERS = int(os.getenv('SCRAPE_WORKERS', 8))
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 4))
+# map-reduce mode: inputs over MAP_REDUCE_MAX_TOKENS are summarized in pieces of at most MAP_REDUCE_CHUNK_TOKENS
+MAP_REDUCE_MAX_TOKENS = int(os.getenv('MAP_REDUCE_MAX_TOKENS', 200000))
+MAP_REDUCE_CHUNK_TOKENS = int(os.getenv('MAP_REDUCE_CHUNK_TOKENS', 50000))
+MAP_REDUCE_WORKERS = int(os.getenv('MAP_REDUCE_WORKERS', 4))
+MAP_PROMPT = "请详细总结这部分内容的要点，保留关键事实、数据、观点和论证过程，使用原文的语言。"
+REDUCE_PROMPT = "以下是同一份材料中连续几部分的要点，请合并为一份完整的要点总结，去除重复，保留关键事实和数据。"
+NOTES_INTRO = "材料篇幅较长，以下是各部分的要点："
+# follow-ups run against a context cache of the turns holding files, 0 turns it off
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', 3600))
+# Gemini refuses to cache less than this
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv('CONTEXT_CACHE_MIN_TOKENS', 32768))
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+}
+SOURCE_LIMITS = {
+    'video': threading.BoundedSemaphore(int(os.getenv('MAX_VIDEO_JOBS', 2))),
+    'pdf': threading.BoundedSemaphore(int(os.getenv('MAX_PDF_JOBS', 4))),
+    'http': threading.BoundedSemaphore(int(os.getenv('MAX_HTTP_JOBS', 8))),
+}
 class GeminiSummarizer(Base):
     __tablename__ = 'conversations'
+    __table_args__ = (Index('ix_conversations_timestamp_id', 'timestamp', 'id'),)
 
     id = Column(String, primary_key=True)
     timestamp = Column(DateTime, default=datetime.now)
-    history = Column(Text)
+    # history lives in the messages table, this column only holds conversations not migrated yet
+    legacy_history = Column('history', Text)
     uri2path = Column(Text)
     files = Column(Text)
     urls = Column(Text)
+    # context cache of the first cache_turns history entries, expire time in UTC
+    cache_name = Column(String)
+    cache_expire_time = Column(DateTime)
+    cache_turns = Column(Integer)
 
     def __init__(self, model="models/gemini-1.5-flash", id=None, files=[], urls=[], db='summarizer', overwrite=False, **kwargs):
         super().__init__()
-        self.model = genai.GenerativeModel(
-            model_name=model,
-            safety_settings={
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            }
-        )
+        self.model = genai.GenerativeModel(model_name=model, safety_settings=SAFETY_SETTINGS)
         self.chat = None
         self.files = files.copy()
         self.urls = urls.copy()
         self.uri2path = {}
         self.ready_files = []
+        self.errors = {}
+        # sha256 of the uploaded files by uri, for the response cache key
+        self.source_hashes = {}
+        self.response_cache = RESPONSE_CACHE and kwargs.get('response_cache', True)
+        # whether the last answer came from the response cache
+        self.cached = False
+        # history before the turn being streamed, the chat can't tell its history until the stream ends
+        self.stream_history = None
         self.timestamp = datetime.now()
         self.history = kwargs.get('history', [])
+        self.saved_turns = 0
         self.db = db
-        self.engine = ENGINES.get(db, ENGINES["summarizer"])
+        self.activation_timeout = kwargs.get('activation_timeout') or ACTIVATION_TIMEOUT
+        self.progress = kwargs.get('progress')
+        self.map_reduce = kwargs.get('map_reduce', False)
+        self.context_cache = kwargs.get('context_cache', True) and CONTEXT_CACHE_TTL > 0
+        self.cache_name = None
+        self.cache_expire_time = None
+        self.cache_turns = 0
+        self.engine = get_engine(db)
         self.Session = sessionmaker(bind=self.engine)
         self.id = self.generate_id(id)
-
-        Base.metadata.create_all(self.engine)
+        set_trace_labels(model=model, db=db)
 
         if not overwrite:
             self.load_conversation(self.id)
@@ -88,9 +120,21 @@ class GeminiSummarizer(Base):
                 self.get_files_and_urls_ready(self.files, self.urls, **kwargs)
         else:
             self.get_files_and_urls_ready(self.files, self.urls, **kwargs)
+        # sources that failed are reported in self.errors, not kept with the conversation
+        self.files = [file for file in self.files if file not in self.errors]
+        self.urls = [url for url in self.urls if url not in self.errors]
 
+        if self.map_reduce and self.ready_files:
+            self.ready_files = self.budget_files(self.ready_files)
         self.prepare_chat(self.ready_files, self.history)
 
+    def span(self, stage, **labels):
+        return span(stage, model=self.model.model_name, db=self.db, **labels)
+
+    def report(self, stage, total=0, done=0):
+        if self.progress:
+            self.progress(stage, total=total, done=done)
+
     def generate_id(self, id=None):
         if not id:
             content = "".join(self.files + self.urls)
@@ -102,14 +146,22 @@ class GeminiSummarizer(Base):
 
     def load_conversation(self, id):
         session = self.Session()
-        stored_conversation = session.query(GeminiSummarizer).filter_by(id=id).first()
-        session.close()
+        try:
+            with self.span('db_load'):
+                stored_conversation = session.query(GeminiSummarizer).filter_by(id=id).first()
+                if stored_conversation:
+                    self.history = [{'role': entry['role'], 'parts': chat_parts(entry['parts'])} for entry in load_history(session, id)]
+        finally:
+            session.close()
 
         if stored_conversation:
-            self.history = json.loads(stored_conversation.history)
+            self.saved_turns = len(self.history)
             self.uri2path = json.loads(stored_conversation.uri2path)
             self.files = json.loads(stored_conversation.files)
             self.urls = json.loads(stored_conversation.urls)
+            self.cache_name = stored_conversation.cache_name
+            self.cache_expire_time = stored_conversation.cache_expire_time
+            self.cache_turns = stored_conversation.cache_turns or 0
             print(f"Loaded existing conversation for ID: {self.id}")
 
     def get_files_and_urls_ready(self, files, urls, extract_images=False, **kwargs):
@@ -119,29 +171,107 @@ class GeminiSummarizer(Base):
             self.ready_files.extend(self.scrape(urls, **kwargs))
 
         if extract_images:
-            image_urls = sum([extract_markdown_images(f.display_name) for f in self.ready_files if f.display_name.endswith('.md')], [])
-            image_files = [download_file(url) for url in image_urls]
+            image_urls = sum([extract_markdown_images(path) for path in map(self.source_path, self.ready_files) if path.endswith('.md')], [])
+            with self.span('images'):
+                image_files = download_images(image_urls)
             self.ready_files.extend(self.upload(image_files))
 
-    @set_gemini_proxy
-    def upload(self, files):
-        uploaded_files = []
-        for file in files:
+    def upload(self, files, timeout=None):
+        self.report('upload', total=len(files))
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            uploaded_files = list(executor.map(propagate(self.upload_file), files))
+        return self.wait_for_files_active(uploaded_files, timeout=timeout, sources=files)
+
+    def upload_file(self, file):
+        with self.span('mime'):
             mime = magic.Magic(mime=True)
             mime_type = mime.from_file(file)
-            if mime_type == 'application/x-subrip':
-                mime_type = 'text/plain'
+        if mime_type == 'application/x-subrip':
+            mime_type = 'text/plain'
+        if mime_type.startswith('text/') and os.path.getsize(file) <= INLINE_TEXT_MAX_BYTES:
+            return self.inline_file(file)
+        sha256 = file_sha256(file)
+        uploaded_file = self.get_cached_upload(sha256, mime_type)
+        if uploaded_file:
+            print(f"Reusing uploaded file '{file}' as: {uploaded_file.uri}")
+        else:
             print(f"Uploading file '{file}' as {mime_type}...")
-            uploaded_file = genai.upload_file(file, mime_type=mime_type, display_name=file)
+            with self.span('upload'):
+                uploaded_file = gemini_client.upload_file(file, mime_type=mime_type, display_name=file)
             print(f"Uploaded file '{uploaded_file.display_name}' as: {uploaded_file.uri}")
-            uploaded_files.append(uploaded_file)
-            self.uri2path[uploaded_file.uri] = file
-        
-        return self.wait_for_files_active(uploaded_files)
+            put_uploaded_file(sha256, mime_type, uploaded_file)
+        self.uri2path[uploaded_file.uri] = file
+        self.source_hashes[uploaded_file.uri] = sha256
+        self.report('upload', done=1)
+        return uploaded_file
+
+    def inline_file(self, file):
+        """
+        Text part of a small text file, sent with the first turn without an upload or activation wait. Its
+        source is kept in uri2path under a uri made of its hash.
+        """
+        with open(file, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        print(f"Sending '{file}' inline")
+        self.uri2path[inline_uri(text)] = file
+        self.report('upload', done=1)
+        return text
+
+    def source_path(self, part):
+        if isinstance(part, str):
+            return self.uri2path.get(inline_uri(part), '')
+        return self.uri2path.get(part.uri, part.display_name)
+
+    def get_cached_upload(self, sha256, mime_type):
+        name = get_uploaded_file(sha256, mime_type)
+        if not name:
+            return None
+        try:
+            uploaded_file = gemini_client.get_file(name)
+        except Exception as e:
+            print(f"Cached file {name} is gone: {e}")
+            uploaded_file = None
+        if uploaded_file and uploaded_file.state.name in ("ACTIVE", "PROCESSING"):
+            return uploaded_file
+        drop_uploaded_file(sha256, mime_type)
+        return None
 
     def scrape(self, urls, scraper='jina', **kwargs):
-        scraped_files = [self.url2file(url, scraper=scraper, **kwargs) for url in urls]
-        return self.upload(scraped_files)
+        uploaded_files = {}
+        for url in urls:
+            self.report(self.source_stage(url), total=1)
+        self.report('upload', total=len(urls))
+        with ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as executor:
+            futures = {executor.submit(propagate(self.scrape_and_upload), url, scraper=scraper, **kwargs): url for url in urls}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    uploaded_files[url] = future.result()
+                except Exception as e:
+                    print(f"Failed to scrape {url}: {e}")
+                    self.errors[url] = str(e)
+
+        if urls and not uploaded_files:
+            raise Exception(f"Failed to scrape any of {', '.join(urls)}")
+        scraped = [url for url in urls if url in uploaded_files]
+        return self.wait_for_files_active([uploaded_files[url] for url in scraped], sources=scraped)
+
+    def scrape_and_upload(self, url, **kwargs):
+        with SOURCE_LIMITS[self.source_type(url)]:
+            file = self.url2file(url, **kwargs)
+        self.report(self.source_stage(url), done=1)
+        return self.upload_file(file)
+
+    def source_stage(self, url):
+        return 'transcribe' if self.is_video_url(url) else 'scrape'
+
+    def source_type(self, url):
+        if self.is_video_url(url):
+            return 'video'
+        elif '.pdf' in url:
+            return 'pdf'
+        else:
+            return 'http'
     
     def is_video_url(self, url):
         return any(list(map(lambda x: x in url, ['youtube.com', 'youtu.be', 'x.com', 'twitter.com', 'www.bilibili.com/video'])))
@@ -150,11 +280,14 @@ class GeminiSummarizer(Base):
         if self.is_video_url(url):
             return download_captions(url, kwargs.get('cookies', kwargs.get('cookies')), 
                                      convert_to_txt=kwargs.get('srt_to_txt', kwargs.get('srt_to_txt')), 
-                                     transcribe=kwargs.get('transcribe', kwargs.get('transcribe', True)))
+                                     transcribe=kwargs.get('transcribe', kwargs.get('transcribe', True)),
+                                     timestamp_interval=kwargs.get('timestamp_interval'))
         elif '.pdf' in url:
-            return download_pdf(url, kwargs.get('pdf_to_markdown'))
+            with self.span('scrape', scraper='pdf'):
+                return download_pdf(url, kwargs.get('pdf_to_markdown'))
         else:
-            return self.url2markdown(url, **kwargs)
+            with self.span('scrape', scraper=kwargs.get('scraper', 'jina')):
+                return self.url2markdown(url, **kwargs)
 
     def url2markdown(self, url, scraper='jina', **kwargs):
         if scraper == 'firecrawl':
@@ -166,38 +299,325 @@ class GeminiSummarizer(Base):
         elif scraper == 'readability_markdownify':
             return readability_markdownify(url)
 
-    @set_gemini_proxy
-    def wait_for_files_active(self, files):
-        ready_files = []
-        print("Waiting for file processing...")
-        for name in (file.name for file in files):
-            file = genai.get_file(name)
-            while file.state.name == "PROCESSING":
+    def wait_for_files_active(self, parts, timeout=None, sources=None):
+        """
+        Poll all pending files together, backing off from 1s up to 10s between rounds. Inline text parts are
+        passed through in place. Files that fail to process are dropped and reported in self.errors under their
+        source, the url or path each part came from.
+        """
+        timeout = timeout or self.activation_timeout
+        deadline = time.monotonic() + timeout
+        files = {part.name: part for part in parts if not isinstance(part, str)}
+        pending = [name for name, file in files.items() if file.state.name == "PROCESSING"]
+        self.report('activate', total=len(files), done=len(files) - len(pending))
+        delay = 1
+        if pending:
+            print("Waiting for file processing...")
+        with self.span('activate'), ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            while pending:
+                if time.monotonic() + delay > deadline:
+                    raise TimeoutError(f"Files {', '.join(pending)} not ready after {timeout}s")
                 print(".", end="", flush=True)
-                time.sleep(10)
-                file = genai.get_file(name)
-            if file.state.name != "ACTIVE":
-                raise Exception(f"File {file.name} failed to process")
+                time.sleep(delay)
+                delay = min(delay * 1.5, 10)
+                for file in executor.map(propagate(gemini_client.get_file), pending):
+                    files[file.name] = file
+                still_pending = [name for name in pending if files[name].state.name == "PROCESSING"]
+                self.report('activate', done=len(pending) - len(still_pending))
+                pending = still_pending
+
+        ready, failed = [], []
+        for part, source in zip(parts, sources or list(map(self.source_path, parts))):
+            file = part if isinstance(part, str) else files[part.name]
+            if isinstance(file, str) or file.state.name == "ACTIVE":
+                ready.append(file)
             else:
-                ready_files.append(file)
+                print(f"File {file.name} from {source} failed to process")
+                self.errors[source] = f"File {file.name} failed to process"
+                failed.append(source)
+        if parts and not ready:
+            raise Exception(f"Failed to process any of {', '.join(failed)}")
         print("...all files ready\n")
-        return ready_files
+        return ready
+
+    def count_tokens(self, content):
+        with self.span('count_tokens'):
+            return gemini_call(self.model.count_tokens, content).total_tokens
+
+    def budget_files(self, files):
+        """
+        Map-reduce: when the files don't fit in MAP_REDUCE_MAX_TOKENS, summarize each file (or each chunk of
+        an oversized text file or PDF) concurrently and start the conversation from the merged notes instead.
+        """
+        with ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS) as executor:
+            counts = list(executor.map(propagate(self.count_tokens), files))
+        total = sum(counts)
+        print(f"Input: {total} tokens in {len(files)} files")
+        if total <= MAP_REDUCE_MAX_TOKENS:
+            return files
+
+        pieces = sum([self.split_file(file, tokens) for file, tokens in zip(files, counts)], [])
+        print(f"Summarizing {len(pieces)} pieces separately...")
+        self.report('map', total=len(pieces))
+        with ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS) as executor:
+            notes = list(executor.map(propagate(self.map_piece), pieces))
+        return [NOTES_INTRO + "\n\n" + self.reduce_notes(notes)]
+
+    def split_file(self, file, tokens):
+        """
+        (label, content) pieces of a file: text files over MAP_REDUCE_CHUNK_TOKENS are cut on line or word boundaries,
+        PDFs into page ranges, anything else is summarized whole unless it's over MAP_REDUCE_MAX_TOKENS on its own.
+        """
+        path = self.source_path(file)
+        if tokens <= MAP_REDUCE_CHUNK_TOKENS:
+            return [(path, file)]
+        elif isinstance(file, str):
+            text = file
+        elif file.mime_type == 'application/pdf' and os.path.exists(path):
+            return self.split_pdf(path, file, tokens)
+        elif file.mime_type.startswith('text/') and os.path.exists(path):
+            with open(path, encoding='utf-8', errors='replace') as f:
+                text = f.read()
+        else:
+            return self.whole_piece(path, file, tokens)
+        count = -(-tokens // MAP_REDUCE_CHUNK_TOKENS)
+        size = len(text) // count + 1
+        chunks, start = [], 0
+        while start < len(text):
+            end = min(start + size, len(text))
+            # the last line break in the window, else the last space: transcripts are often a single line
+            for separator in ('\n', ' ') if end < len(text) else ():
+                cut = text.rfind(separator, start + 1, end)
+                if cut != -1:
+                    end = cut + 1
+                    break
+            chunks.append(text[start:end])
+            start = end
+        pieces = []
+        for i, chunk in enumerate(chunks, 1):
+            # tokens estimated from the chunk's share of the text
+            pieces += self.whole_piece(f"{path} ({i}/{len(chunks)})", chunk, tokens * len(chunk) // len(text))
+        return pieces
+
+    def whole_piece(self, path, file, tokens):
+        if tokens > MAP_REDUCE_MAX_TOKENS:
+            raise Exception(f"{path} is too large to summarize: {tokens} tokens and it can't be split")
+        return [(path, file)]
+
+    def split_pdf(self, path, file, tokens):
+        """
+        Page ranges of about MAP_REDUCE_CHUNK_TOKENS each, written next to the PDF and uploaded as pieces of their own.
+        """
+        reader = PdfReader(path)
+        pages = len(reader.pages)
+        if pages < 2:
+            return self.whole_piece(path, file, tokens)
+        size = -(-pages // min(pages, -(-tokens // MAP_REDUCE_CHUNK_TOKENS)))
+        labels = {}
+        for start in range(0, pages, size):
+            end = min(start + size, pages)
+            writer = PdfWriter()
+            for page in reader.pages[start:end]:
+                writer.add_page(page)
+            filename = f"{os.path.splitext(path)[0]}.pages-{start + 1}-{end}.pdf"
+            writer.write(filename)
+            labels[filename] = f"{path} (p. {start + 1}-{end})"
+        pieces = []
+        for part in self.upload(list(labels)):
+            # the pieces only feed the map step, they aren't sources of the conversation
+            pieces.append((labels[self.uri2path.pop(part.uri)], part))
+            self.source_hashes.pop(part.uri, None)
+        return pieces
+
+    def map_piece(self, piece):
+        label, content = piece
+        with self.span('map'):
+            response = gemini_call(self.model.generate_content, [content, MAP_PROMPT])
+        self.report('map', done=1)
+        return f"## {label}\n\n{response.text}"
+
+    def reduce_notes(self, notes):
+        """
+        Merge neighbouring notes until they fit in MAP_REDUCE_MAX_TOKENS.
+        """
+        with ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS) as executor:
+            while len(notes) > 1:
+                counts = list(executor.map(propagate(self.count_tokens), notes))
+                if sum(counts) <= MAP_REDUCE_MAX_TOKENS:
+                    break
+                batches, size = [[]], 0
+                for note, tokens in zip(notes, counts):
+                    if batches[-1] and size + tokens > MAP_REDUCE_CHUNK_TOKENS:
+                        batches.append([])
+                        size = 0
+                    batches[-1].append(note)
+                    size += tokens
+                if len(batches) == len(notes):
+                    # every note is a batch of its own, merging can't make progress
+                    break
+                print(f"Merging {len(notes)} notes into {len(batches)}...")
+                notes = list(executor.map(propagate(self.reduce_batch), batches))
+        return "\n\n".join(notes)
+
+    def reduce_batch(self, batch):
+        with self.span('reduce'):
+            return gemini_call(self.model.generate_content, ["\n\n".join(batch), REDUCE_PROMPT]).text
 
     def prepare_chat(self, ready_files=[], history=[]):
         if ready_files:
             history.append({"role": "user", "parts": ready_files})
         self.chat = self.model.start_chat(history=history)
 
-    @set_gemini_proxy
-    def send(self, message):
-        response = self.chat.send_message(message)
+    def send(self, message, bypass_cache=False):
+        key = self.response_cache_key(message)
+        self.cached = bool(key) and not bypass_cache and self.use_cached_response(key, message)
+        if self.cached:
+            return self.chat.history[-1].parts[0].text
+        self.use_context_cache()
+        with self.span('send'):
+            response = gemini_call(self.chat.send_message, message)
+        if key:
+            put_cached_response(key, self.model.model_name, response.text)
         return response.text
 
+    def start_stream(self, message):
+        self.use_context_cache()
+        return gemini_call(self.chat.send_message, message, stream=True)
+
+    def response_cache_key(self, message):
+        """
+        Key of the first question about the sources, None when the response cache doesn't apply: it's off, the
+        conversation already went on, or a source can't be hashed.
+        """
+        if not self.response_cache or len(self.chat.history) != 1:
+            return None
+        hashes = []
+        for part in self.chat.history[0].parts:
+            if 'file_data' in part:
+                uri = part.file_data.file_uri
+                if uri not in self.source_hashes:
+                    path = self.uri2path.get(uri)
+                    if not path or not os.path.exists(path):
+                        return None
+                    self.source_hashes[uri] = file_sha256(path)
+                hashes.append(self.source_hashes[uri])
+            else:
+                hashes.append(hashlib.sha256(part.text.encode()).hexdigest())
+        return response_key(hashes, message, self.model.model_name)
+
+    def use_cached_response(self, key, message):
+        with self.span('response_cache'):
+            response = get_cached_response(key)
+        if response is None:
+            return False
+        print(f"Reusing cached response {key[:12]}")
+        self.chat.history = self.chat.history + [{'role': 'user', 'parts': [message]}, {'role': 'model', 'parts': [response]}]
+        return True
+
+    def cached_turns(self):
+        """
+        Length of the history prefix worth caching: everything up to the last turn holding files or inline sources.
+        """
+        history = self.chat.history
+        turns = [i for i, entry in enumerate(history)
+                 if any('file_data' in part or inline_uri(part.text) in self.uri2path for part in entry.parts)]
+        return turns[-1] + 1 if turns else 0
+
+    def use_context_cache(self):
+        """
+        Run the chat against a context cache of its file-bearing prefix, falling back to the plain model.
+        """
+        turns = self.cached_turns() if self.context_cache else 0
+        # only follow-ups read the prefix again, a one-shot summary isn't worth a count_tokens call and a cache
+        if not any(entry.role == 'model' for entry in self.chat.history[turns:]):
+            turns = 0
+        try:
+            cached_content = self.get_context_cache(turns) if turns else None
+            if not cached_content:
+                self.chat.model = self.model
+            elif getattr(self.chat.model, 'cache_name', None) != self.cache_name:
+                self.chat.model = CachedPrefixModel(self.model, cached_content, turns, safety_settings=SAFETY_SETTINGS,
+                                                    on_miss=self.drop_context_cache)
+        except NotFound as e:
+            print(f"Context cache {self.cache_name} is gone: {e}")
+            self.drop_context_cache()
+            self.chat.model = self.model
+        except Exception as e:
+            print(f"Context cache failed, sending the full history: {e}")
+            self.context_cache = False
+            self.chat.model = self.model
+
+    def get_context_cache(self, turns):
+        """
+        Reuse the stored cache, extended once past half its TTL, or create one when it expired or the prefix grew.
+        """
+        if self.cache_name and self.cache_turns == turns and self.cache_expire_time > utcnow() + timedelta(seconds=60):
+            if self.cache_expire_time - utcnow() < timedelta(seconds=CONTEXT_CACHE_TTL / 2):
+                self.set_context_cache(gemini_call(extend_context_cache, self.cache_name, CONTEXT_CACHE_TTL), turns)
+            return self.cache_name
+        return self.create_context_cache(turns)
+
+    def create_context_cache(self, turns):
+        prefix = self.chat.history[:turns]
+        tokens = self.count_tokens(prefix)
+        if tokens < CONTEXT_CACHE_MIN_TOKENS:
+            # too small to cache, don't count again for this conversation
+            self.context_cache = False
+            return None
+        if self.cache_name and self.cache_expire_time > utcnow():
+            delete_context_cache(self.cache_name)
+        with self.span('context_cache'):
+            cached_content = gemini_call(create_context_cache, self.model, prefix, CONTEXT_CACHE_TTL, display_name=self.id[:128])
+        print(f"Cached {tokens} tokens of context as {cached_content.name}")
+        self.set_context_cache(cached_content, turns)
+        return cached_content
+
+    def set_context_cache(self, cached_content, turns):
+        expire_time = cached_content.expire_time
+        if expire_time.tzinfo:
+            expire_time = expire_time.astimezone(timezone.utc).replace(tzinfo=None)
+        self.cache_name = cached_content.name
+        self.cache_expire_time = expire_time
+        self.cache_turns = turns
+
+    def drop_context_cache(self):
+        self.cache_name = None
+        self.cache_expire_time = None
+        self.cache_turns = 0
+
+    def send_stream(self, message, bypass_cache=False):
+        """
+        Yield the response text chunk by chunk. The turn only lands in chat.history once the stream is
+        exhausted; if the consumer stops early the incomplete turn is rewound.
+        """
+        key = self.response_cache_key(message)
+        self.cached = bool(key) and not bypass_cache and self.use_cached_response(key, message)
+        if self.cached:
+            yield self.chat.history[-1].parts[0].text
+            return
+        self.stream_history = list(self.chat.history)
+        with self.span('send'):
+            completed = False
+            try:
+                response = self.start_stream(message)
+                for chunk in response:
+                    if chunk.parts:
+                        yield chunk.text
+                completed = True
+                if key:
+                    put_cached_response(key, self.model.model_name, response.text)
+            finally:
+                if not completed:
+                    # an unfinished stream raises IncompleteIterationError on anything reading it, rewind()
+                    # included: setting the history drops the pending turn without reading the response
+                    self.chat.history = self.stream_history
+                self.stream_history = None
+
     @property
     def json(self):
         if not self.chat:
             return []
-        return self.history2json(self.chat.history)
+        return self.history2json(self.chat_history())
 
     @property
     def markdown(self):
@@ -218,74 +638,67 @@ class GeminiSummarizer(Base):
         def format_part(part):
             if 'file_data' in part:
                 return {"file_data": {"mime_type": part.file_data.mime_type, "file_uri": part.file_data.file_uri}}
+            elif inline_uri(part.text) in self.uri2path:
+                return {"text": part.text, "source": self.uri2path[inline_uri(part.text)]}
             else:
                 return part.text
             
         return [format_entry(e) for e in history]
 
     def history2markdown(self, history):
-        def format_part_markdown(part, prefix):
-            if 'file_data' in part:
-                if self.uri2path:
-                    return '# ' + os.path.basename(self.uri2path[part['file_data']['file_uri']])
-                else:
-                    return '# ' + part['file_data']['file_uri']
-            else:
-                if isinstance(part, str):
-                    return prefix + part
-                else:    
-                    return prefix + part['text']
-        
-        md = []
-        if self.urls:
-            md.append("> " + "\n".join(self.urls))
-        for entry in history:
-            if entry['role'] == 'user':
-                md.append("-" * 10)
-                prefix = "> "
-            else:
-                prefix = ""
-            md.append("\n\n".join([format_part_markdown(part, prefix) for part in entry['parts']]))
-        return "\n\n".join(md)
+        return history2markdown(history, self.urls, self.uri2path)
 
     def save(self):
-        if self.chat:
+        """
+        Append the turns added since the last save, the history is only rewritten when it got shorter or
+        the conversation is saved for the first time.
+        """
+        if not self.chat:
+            return
+        chat_history = self.chat_history()
+        with self.span('db_save'):
             session = self.Session()
-            self.to_string()
-            session.merge(self)
-            session.commit()
-            session.close()
-            print(f"Saved conversation with ID: {self.id} into {self.db}.db")
-            self.from_string()
+            try:
+                if self.saved_turns == 0 or len(chat_history) < self.saved_turns:
+                    stored_turns = session.query(Message).filter_by(conversation_id=self.id).delete()
+                    unindex_messages(session, self.id, stored_turns)
+                    self.saved_turns = 0
+                new_turns = list(enumerate(self.history2json(chat_history[self.saved_turns:]), start=self.saved_turns))
+                session.add_all(Message(conversation_id=self.id, seq=seq, role=entry['role'], parts=json.dumps(entry['parts']))
+                                for seq, entry in new_turns)
+                index_messages(session, self.id, new_turns)
+                index_conversation(session, self.id, self.uri2path, self.files, self.urls)
+                self.to_string()
+                try:
+                    session.merge(self)
+                    session.commit()
+                finally:
+                    self.from_string()
+            finally:
+                session.close()
+        self.saved_turns = len(chat_history)
+        print(f"Saved conversation with ID: {self.id} into {self.db}.db")
+
+    def chat_history(self):
+        """
+        chat.history without the turn being streamed, if any.
+        """
+        stream_history = self.stream_history
+        return stream_history if stream_history is not None else self.chat.history
 
     def to_string(self):
-        self.history = json.dumps(self.json)
         self.files = json.dumps(self.files)
         self.urls = json.dumps(self.urls)
         self.uri2path = json.dumps(self.uri2path)
 
     def from_string(self):
-        self.history = json.loads(self.history)
         self.files = json.loads(self.files)
         self.urls = json.loads(self.urls)
         self.uri2path = json.loads(self.uri2path)
 
     def delete(self):
-        session = self.Session()
-        try:
-            # Check if the object exists in the database
-            existing = session.query(GeminiSummarizer).filter_by(id=self.id).first()
-            if existing:
-                session.delete(existing)
-                session.commit()
-                print(f"Deleted conversation with ID: {self.id}")
-            else:
-                print(f"Conversation with ID: {self.id} not found in database, skipping deletion")
-        except Exception as e:
-            print(f"Error deleting conversation: {e}")
-            session.rollback()
-        finally:
-            session.close()
+        if not delete_conversation(self.id, self.db):
+            print(f"Conversation with ID: {self.id} not found in database, skipping deletion")
 
     def export(self, formats=[]):
         if (self.files is None or len(self.files) == 0) and self.urls:
@@ -300,30 +713,276 @@ class GeminiSummarizer(Base):
 
         prefix = os.path.splitext(os.path.join(dirname, basename))[0]
 
+        exported = []
         if 'json' in formats:
             write_flie(prefix + ".history.json", json.dumps(self.json))
+            exported.append(prefix + ".history.json")
         if 'markdown' in formats:
             write_flie(prefix + ".gemini.md", self.markdown)
+            exported.append(prefix + ".gemini.md")
+        return exported
+
+def history2markdown(history, urls=[], uri2path={}):
+    def format_part_markdown(part, prefix):
+        if 'file_data' in part:
+            if uri2path:
+                return '# ' + os.path.basename(uri2path[part['file_data']['file_uri']])
+            else:
+                return '# ' + part['file_data']['file_uri']
+        elif isinstance(part, dict) and 'source' in part:
+            return '# ' + os.path.basename(part['source'])
+        else:
+            if isinstance(part, str):
+                return prefix + part
+            else:    
+                return prefix + part['text']
+    
+    md = []
+    if urls:
+        md.append("> " + "\n".join(urls))
+    for entry in history:
+        if entry['role'] == 'user':
+            md.append("-" * 10)
+            prefix = "> "
+        else:
+            prefix = ""
+        md.append("\n\n".join([format_part_markdown(part, prefix) for part in entry['parts']]))
+    return "\n\n".join(md)
+
+class Message(Base):
+    __tablename__ = 'messages'
+
+    conversation_id = Column(String, primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    role = Column(String)
+    parts = Column(Text)
+
+def load_history(session, id, last=None):
+    """
+    Stored turns of a conversation in order, only the last ones if asked.
+    """
+    query = session.query(Message).filter_by(conversation_id=id)
+    if last:
+        messages = query.order_by(Message.seq.desc()).limit(last).all()[::-1]
+    else:
+        messages = query.order_by(Message.seq).all()
+    return [{'role': message.role, 'parts': json.loads(message.parts)} for message in messages]
+
+def chat_parts(parts):
+    # inline sources are stored with their path, the model only gets the text
+    return [part['text'] if isinstance(part, dict) and 'source' in part else part for part in parts]
+
+def inline_uri(text):
+    return 'inline:' + hashlib.sha256(text.encode()).hexdigest()
+
+def migrate_history(connection):
+    """
+    Move histories stored as one JSON blob in the conversations table into the messages table.
+    """
+    rows = connection.execute(text("SELECT id, history, uri2path, files, urls FROM conversations WHERE history IS NOT NULL")).all()
+    for row in rows:
+        turns = list(enumerate(json.loads(row.history) if row.history else []))
+        connection.execute(Message.__table__.delete().where(Message.conversation_id == row.id))
+        if turns:
+            connection.execute(Message.__table__.insert(), [
+                {'conversation_id': row.id, 'seq': seq, 'role': entry['role'], 'parts': json.dumps(entry['parts'])}
+                for seq, entry in turns])
+        index_messages(connection, row.id, turns)
+        index_conversation(connection, row.id, *[json.loads(v) for v in (row.uri2path, row.files, row.urls)])
+        connection.execute(text("UPDATE conversations SET history = NULL WHERE id = :id"), {'id': row.id})
+    if rows:
+        print(f"Migrated {len(rows)} conversations to the messages table")
+
+class ConversationRecord:
+    """
+    Read-only view of a stored conversation. Loading it is a single primary key lookup, no model or chat session is built.
+    """
+    def __init__(self, id, timestamp, history, uri2path, files, urls):
+        self.id = id
+        self.timestamp = timestamp
+        self.history = history
+        self.uri2path = uri2path
+        self.files = files
+        self.urls = urls
+
+    @classmethod
+    def load(cls, id, db='summarizer', last=None, history=True):
+        """
+        history=False skips the messages, for when only the metadata is needed.
+        """
+        session = sessionmaker(bind=get_engine(db))()
+        try:
+            row = session.query(GeminiSummarizer.id, GeminiSummarizer.timestamp, GeminiSummarizer.uri2path,
+                                GeminiSummarizer.files, GeminiSummarizer.urls).filter_by(id=id).first()
+            if not row:
+                return None
+            history = load_history(session, id, last) if history else None
+        finally:
+            session.close()
+        return cls(row.id, row.timestamp, history, json.loads(row.uri2path),
+                   json.loads(row.files), json.loads(row.urls))
 
-def query_history(offset, limit, filtering=None, db=''):
-    engine = ENGINES.get(db, ENGINES["summarizer"])
-    session = sessionmaker(bind=engine)()
-    query = session.query(GeminiSummarizer)
-    if filtering:
-        print(filtering)
-        query = query.filter(
-            GeminiSummarizer.urls.like(f'%{filtering}%') |
-            GeminiSummarizer.files.like(f'%{filtering}%') |
-            GeminiSummarizer.uri2path.like(f'%{filtering}%')
-        )
-    result = query.order_by(GeminiSummarizer.timestamp.desc()).offset(offset).limit(limit).all() 
-    session.close()
-    return result
+    @property
+    def json(self):
+        return self.history
+
+    @property
+    def markdown(self):
+        return history2markdown(self.history, self.urls, self.uri2path)
+
+    @property
+    def dict(self):
+        return {'id': self.id, 'urls': self.urls, 'files': self.files, 'timestamp': self.timestamp, 'ready_files': self.uri2path}
+
+def conversation_exists(id, db='summarizer'):
+    session = sessionmaker(bind=get_engine(db))()
+    try:
+        return session.query(GeminiSummarizer.id).filter_by(id=id).first() is not None
+    finally:
+        session.close()
+
+def delete_conversation(id, db='summarizer'):
+    session = sessionmaker(bind=get_engine(db))()
+    try:
+        stored_conversation = session.query(GeminiSummarizer).filter_by(id=id).first()
+        if stored_conversation and stored_conversation.cache_name:
+            delete_context_cache(stored_conversation.cache_name)
+        stored_turns = session.query(Message).filter_by(conversation_id=id).delete()
+        deleted = session.query(GeminiSummarizer).filter_by(id=id).delete()
+        unindex_messages(session, id, stored_turns)
+        unindex_conversation(session, id)
+        session.commit()
+    finally:
+        session.close()
+    if deleted:
+        print(f"Deleted conversation with ID: {id}")
+    return deleted > 0
 
+def get_engine(db):
+    return ENGINES.get(db if db in DBS else "summarizer")
+
+def add_missing_columns(connection, table):
+    # create_all doesn't alter tables that already exist
+    existing = {row[1] for row in connection.execute(text(f"PRAGMA table_info({table.name})"))}
+    for column in table.columns:
+        if column.name not in existing:
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(connection.dialect)}"))
+
+def create_schema(engine):
+    """
+    Runs once per engine, when it is first opened.
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        add_missing_columns(connection, GeminiSummarizer.__table__)
+        # create_all skips indexes of tables that already exist
+        for index in GeminiSummarizer.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        create_fts(connection)
+        migrate_history(connection)
+
+def query_history(offset, limit, filtering=None, db='', cursor=None):
+    """
+    One page of stored conversations and the cursor of the next one. Searchable filters are ranked by
+    relevance through the full-text index, otherwise the newest come first.
+    """
+    session = sessionmaker(bind=get_engine(db))()
+    try:
+        if filtering and is_searchable(filtering):
+            ids, next_cursor = search(session, filtering, limit, offset, cursor)
+            rows = {row.id: row for row in session.query(GeminiSummarizer).filter(GeminiSummarizer.id.in_(ids))}
+            return [rows[id] for id in ids if id in rows], next_cursor
+
+        query = session.query(GeminiSummarizer)
+        if filtering:
+            # too short for the trigram index, scan instead
+            query = query.filter(
+                GeminiSummarizer.urls.like(f'%{filtering}%') |
+                GeminiSummarizer.files.like(f'%{filtering}%') |
+                GeminiSummarizer.uri2path.like(f'%{filtering}%') |
+                GeminiSummarizer.id.in_(text("SELECT id FROM conversations_fts WHERE instr(lower(content), lower(:term)) > 0").bindparams(term=filtering))
+            )
+        query = query.order_by(GeminiSummarizer.timestamp.desc(), GeminiSummarizer.id.desc())
+        if cursor:
+            timestamp, id = decode_cursor(cursor)
+            timestamp = datetime.fromisoformat(timestamp)
+            query = query.filter(or_(GeminiSummarizer.timestamp < timestamp,
+                                     and_(GeminiSummarizer.timestamp == timestamp, GeminiSummarizer.id < id)))
+        else:
+            query = query.offset(offset)
+        result = query.limit(limit).all()
+        next_cursor = encode_cursor(result[-1].timestamp.isoformat(), result[-1].id) if len(result) == limit else None
+        return result, next_cursor
+    finally:
+        session.close()
+
+
+def read_manifest(manifest):
+    """
+    (key, item) for every line of a jsonl manifest. An item holds files/urls, a prompt and any other
+    GeminiSummarizer option; its key is its id or, without one, a hash of the line.
+    """
+    with open(manifest, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            yield item.get('id') or hashlib.sha256(line.strip().encode()).hexdigest()[:16], item
+
+def read_checkpoint(report_file):
+    if not os.path.exists(report_file):
+        return set()
+    with open(report_file, encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return {row['key'] for row in rows if row['status'] == 'done'}
+
+def run_batch_item(key, item, defaults):
+    options = dict(defaults, **item)
+    trace = start_trace(batch=key, model=options.get('model'), db=options.get('db'))
+    row = {'key': key, 'status': 'failed', 'conversation_id': None, 'error': None, 'errors': None, 'exports': [], 'cached': False}
+    try:
+        summarizer = GeminiSummarizer(**options)
+        row['conversation_id'] = summarizer.id
+        row['errors'] = summarizer.errors or None
+        summarizer.send(options['prompt'], bypass_cache=options.get('bypass_response_cache', False))
+        row['cached'] = summarizer.cached
+        summarizer.save()
+        row['exports'] = summarizer.export(options.get('export_formats') or [])
+        row['status'] = 'done'
+    except Exception as e:
+        print(f"Batch item {key} failed: {e}")
+        row['error'] = str(e)
+    finally:
+        row['seconds'] = round(time.monotonic() - trace.start, 3)
+        row['spans'] = trace.breakdown()
+        end_trace(trace, 'batch', row['status'])
+    return row
+
+def run_batch(manifest, defaults, workers=BATCH_WORKERS, report_file=None):
+    """
+    Summarize every item of the manifest as its own conversation, `workers` at a time, in one process. A row per
+    item is appended to the report as soon as it finishes; rerunning skips the items already done.
+    """
+    report_file = report_file or os.path.splitext(manifest)[0] + '.report.jsonl'
+    done = read_checkpoint(report_file)
+    items = [(key, item) for key, item in read_manifest(manifest) if key not in done]
+    print(f"Batch {manifest}: {len(items)} to run, {len(done)} already done, report in {report_file}")
+    lock = threading.Lock()
+    counts = {'done': 0, 'failed': 0}
+    with open(report_file, 'a', encoding='utf-8') as report, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_batch_item, key, item, defaults) for key, item in items]
+        for future in as_completed(futures):
+            row = future.result()
+            with lock:
+                report.write(json.dumps(row, ensure_ascii=False) + "\n")
+                report.flush()
+                counts[row['status']] += 1
+    print(f"Batch finished: {counts['done']} done, {counts['failed']} failed")
+    return counts
 
 # Usage example:
 if __name__ == '__main__':
-    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+    gemini_client.configure()
 
     parser = argparse.ArgumentParser(description='Gemini Summarize')
     parser.add_argument('--files', nargs="*", help='Files to upload.', default=[])
@@ -332,6 +991,11 @@ if __name__ == '__main__':
     parser.add_argument('--prompt', help='prompt', default="请根据视频字幕总结主持人的主要观点")
     parser.add_argument('--model', help='model', default="models/gemini-1.5-flash")
     parser.add_argument('--srt_to_txt', help='convert srt to txt', action='store_true', default=False)
+    parser.add_argument('--bypass_response_cache', help="don't answer the prompt from the response cache", action='store_true', default=False)
+    parser.add_argument('--no_context_cache', help="don't cache the files for follow-up questions", dest='context_cache', action='store_false', default=True)
+    parser.add_argument('--map_reduce', help='summarize inputs over the token budget piece by piece: text is split by lines, PDFs by pages, '
+                        'other files too large on their own are rejected', action='store_true', default=False)
+    parser.add_argument('--timestamp_interval', type=int, help='with --srt_to_txt, keep a timestamp every N seconds', default=None)
     parser.add_argument('--question', help='ask question after summarize', action='store_true', default=False)
     parser.add_argument('--load_history', dest='id', help='load history from db', default=None)
     parser.add_argument('--save_history', help='save history to db', action='store_true', default=False)
@@ -346,11 +1010,20 @@ if __name__ == '__main__':
     parser.add_argument('--timeout', type=int, help='timout (jina scraper option)', default=30)
     parser.add_argument('--pdf_to_markdown', help='convert pdf to markdown', action='store_true', default=False)
     parser.add_argument('--no_transcribe', help="don't transcribe audio files", dest='transcribe', action='store_false', default=True)
+    parser.add_argument('--activation_timeout', type=int, help='seconds to wait for uploaded files to become active', default=ACTIVATION_TIMEOUT)
     parser.add_argument('--extract_images', help='extract images', action='store_true', default=False)
     parser.add_argument('--export_formats', nargs="*", help='export formats (json, markdown)', default=[])
+    parser.add_argument('--batch', help='jsonl manifest, one conversation per line, the other options are the defaults', default=None)
+    parser.add_argument('--batch_workers', type=int, help='conversations run at once in batch mode', default=BATCH_WORKERS)
+    parser.add_argument('--batch_report', help='jsonl report and checkpoint of the batch, <manifest>.report.jsonl by default', default=None)
 
     args = parser.parse_args()
 
+    if args.batch:
+        defaults = {k: v for k, v in vars(args).items() if k not in ('batch', 'batch_workers', 'batch_report', 'id', 'question', 'save_history')}
+        counts = run_batch(args.batch, defaults, args.batch_workers, args.batch_report)
+        raise SystemExit(1 if counts['failed'] else 0)
+
     # Create a new summarizer instance with files and URLs
     summarizer = GeminiSummarizer(**vars(args))
     if args.save_history:
@@ -365,8 +1038,9 @@ if __name__ == '__main__':
         print("> " + args.prompt + "\n")
     
     # Send a message
-    response = summarizer.send(args.prompt)
-    print(response)
+    for chunk in summarizer.send_stream(args.prompt, bypass_cache=args.bypass_response_cache):
+        print(chunk, end="", flush=True)
+    print()
     
     if args.question:
         while True:
@@ -374,5 +1048,7 @@ if __name__ == '__main__':
             msg = input(">请输入其他问题：")
             if msg == "":
                 continue
-            response = summarizer.send(msg)
-            print("\n" + response)
+            print()
+            for chunk in summarizer.send_stream(msg):
+                print(chunk, end="", flush=True)
+            print()
@@ -1,12 +1,19 @@
-from flask import Flask, request, jsonify, send_file, render_template, send_from_directory
+from flask import Flask, Response, request, g, jsonify, send_file, render_template, send_from_directory, stream_with_context
 from flask_httpauth import HTTPTokenAuth
 import atexit
+import json
+import queue
+from functools import partial
 from typing import Dict
 import os
-import threading
 import pdb
 from werkzeug.utils import secure_filename
-from Summarize import GeminiSummarizer, genai, query_history
+from Summarize import GeminiSummarizer, ConversationRecord, conversation_exists, query_history, delete_conversation as delete_stored_conversation
+import gemini_client
+from jobs import submit_job, get_job, start_workers
+from session_cache import SessionCache
+from rate_limit import rate_limit_stats
+import metrics
 from tokens import tokens
 
 
@@ -16,15 +23,38 @@ auth = HTTPTokenAuth(scheme='Bearer')
 
 
 # In-memory storage for active conversations
-active_conversations = {db: {} for db in tokens.values()}
-active_conversations_lock = threading.Lock()
+active_conversations = SessionCache()
 
 # Load the API key
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+gemini_client.configure()
+
+# not worth a log line each
+UNTRACED_ENDPOINTS = {'index', 'manifest', 'favicon', 'statics', 'static', 'prometheus_metrics'}
+
+@app.before_request
+def ensure_job_workers():
+    start_workers(create_summarizer)
+
+@app.before_request
+def start_request_trace():
+    if request.endpoint not in UNTRACED_ENDPOINTS:
+        g.trace = metrics.start_trace(method=request.method, path=request.path)
+
+@app.after_request
+def record_response_status(response):
+    g.status = response.status_code
+    return response
+
+@app.teardown_request
+def end_request_trace(error=None):
+    # runs once a streamed response is fully sent, so the log line covers the whole stream
+    if 'trace' in g:
+        metrics.end_trace(g.pop('trace'), request.endpoint, g.get('status', 500), error=str(error) if error else None)
 
 @auth.verify_token
 def verify_token(token):
     if token in tokens:
+        metrics.set_trace_labels(db=tokens[token])
         return tokens[token]
     return None
 
@@ -45,12 +75,32 @@ def create_conversation():
         data = request.json
     
     data['db'] = auth.current_user()
-    summarizer = GeminiSummarizer(**data)
-    with active_conversations_lock:
-        active_conversations[data['db']][summarizer.id] = summarizer
+    if data.pop('async', False) or request.args.get('async') == 'true':
+        try:
+            job_id = submit_job(data)
+        except queue.Full:
+            return jsonify({"error": "Too many pending jobs, try again later"}), 503
+        return jsonify({"job_id": job_id}), 202, {'Location': f'/jobs/{job_id}'}
+
+    return jsonify(create_summarizer(data)), 201
+
+def create_summarizer(data, progress=None):
+    summarizer = GeminiSummarizer(**data, progress=progress)
+    active_conversations.put(data['db'], summarizer.id, summarizer)
     summarizer.save()
-    
-    return jsonify({"conversation_id": summarizer.id}), 201
+
+    result = {"conversation_id": summarizer.id}
+    if summarizer.errors:
+        result["errors"] = summarizer.errors
+    return result
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@auth.login_required
+def get_job_status(job_id):
+    job = get_job(job_id, db=auth.current_user())
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.dict), 200
 
 @app.route('/conversations', methods=['GET'])
 @auth.login_required
@@ -60,42 +110,66 @@ def list_conversations():
     query_db = request.args.get('db') == 'true'
     filtering = request.args.get('filtering', None)
 
+    cursor = request.args.get('cursor') or None
+
+    headers = {}
     if query_db:
-        conversations = [e.dict for e in query_history(offset, limit, filtering, db=auth.current_user())]
+        conversations, next_cursor = query_history(offset, limit, filtering, db=auth.current_user(), cursor=cursor)
+        conversations = [e.dict for e in conversations]
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
     else:
-        with active_conversations_lock:
-            conversations = [v.dict for v in active_conversations[auth.current_user()].values()]
+        conversations = [v.dict for v in active_conversations.values(auth.current_user())]
         if filtering:
             conversations = filter(lambda e: filtering in "\n".join(e['urls'] + e['files'] + list(e['ready_files'].values())), conversations)
         conversations = sorted(conversations, key=lambda e: e['timestamp'], reverse=True)[offset:offset+limit]
-    return jsonify(conversations), 200
+    return jsonify(conversations), 200, headers
 
 @app.route('/conversations/<conversation_id>', methods=['PUT'])
 @auth.login_required
 def save_conversation(conversation_id):
-    with active_conversations_lock:
-        summarizer = active_conversations[auth.current_user()].get(conversation_id)
+    summarizer = active_conversations.pop(auth.current_user(), conversation_id)
     if summarizer:
         summarizer.save()
-        active_conversations[auth.current_user()].pop(conversation_id)
         return jsonify({"message": f"Conversation {conversation_id} saved successfully"}), 200
     else:
         return jsonify({"error": "Conversation not found"}), 404
 
-def get_summarizer(conversation_id, cache=False):
-    with active_conversations_lock:
-        summarizer = active_conversations[auth.current_user()].get(conversation_id, GeminiSummarizer(id=conversation_id, db=auth.current_user()))
-    if summarizer.history:
-        if cache and conversation_id not in active_conversations[auth.current_user()]:
-            active_conversations[auth.current_user()][conversation_id] = summarizer
+def get_summarizer(conversation_id, lease=False):
+    """
+    Active conversation ready to chat, hydrated from the db and cached on first use. A leased one stays in the
+    cache until release_summarizer().
+    """
+    summarizer = active_conversations.get(auth.current_user(), conversation_id, lease=lease)
+    if summarizer:
         return summarizer
-    else:
+
+    if not conversation_exists(conversation_id, db=auth.current_user()):
         return None
+    summarizer = GeminiSummarizer(id=conversation_id, db=auth.current_user())
+    active_conversations.put(auth.current_user(), conversation_id, summarizer, lease=lease)
+    return summarizer
+
+def release_summarizer(db, summarizer):
+    active_conversations.release(db, summarizer.id, summarizer)
+
+def get_record(conversation_id, last=None, history=True):
+    """
+    Read-only view of a conversation, served from the active one if cached. `last` limits it to the last turns,
+    history=False leaves the messages out.
+    """
+    summarizer = active_conversations.get(auth.current_user(), conversation_id)
+    if summarizer and last:
+        return ConversationRecord(summarizer.id, summarizer.timestamp, summarizer.json[-last:],
+                                  summarizer.uri2path, summarizer.files, summarizer.urls)
+    elif summarizer:
+        return summarizer
+    return ConversationRecord.load(conversation_id, db=auth.current_user(), last=last, history=history)
     
 @app.route('/conversations/<conversation_id>', methods=['GET'])
 @auth.login_required
 def get_conversation(conversation_id):
-    summarizer = get_summarizer(conversation_id)
+    summarizer = get_record(conversation_id, history=False)
     if not summarizer:
         return jsonify({"error": "Conversation not found"}), 404
     
@@ -104,11 +178,9 @@ def get_conversation(conversation_id):
 @app.route('/conversations/<conversation_id>', methods=['DELETE'])
 @auth.login_required
 def delete_conversation(conversation_id):
-    with active_conversations_lock:
-        summarizer = active_conversations[auth.current_user()].pop(conversation_id, GeminiSummarizer(id=conversation_id, db=auth.current_user()))
+    active_conversations.pop(auth.current_user(), conversation_id)
 
-    if summarizer.history:
-        summarizer.delete()
+    if delete_stored_conversation(conversation_id, db=auth.current_user()):
         return '', 204
     else:
         return jsonify({"error": "Conversation not found"}), 404
@@ -116,23 +188,47 @@ def delete_conversation(conversation_id):
 @app.route('/conversations/<conversation_id>/messages', methods=['POST'])
 @auth.login_required
 def send_message(conversation_id):
-    summarizer = get_summarizer(conversation_id, cache=True)
-    if not summarizer:
-        return jsonify({"error": "Conversation not found"}), 404
-    
     message = request.json.get('message')
     if not message:
         return jsonify({"error": "Message is required"}), 400
     else:
         print(message)
-    
-    response = summarizer.send(message)
-    return jsonify({"response": response})
+
+    # leased so it isn't evicted, and its new turns lost, while the message is answered
+    summarizer = get_summarizer(conversation_id, lease=True)
+    if not summarizer:
+        return jsonify({"error": "Conversation not found"}), 404
+
+    bypass_cache = request.json.get('no_cache', False) or request.args.get('no_cache') == 'true'
+    if request.json.get('stream') or request.args.get('stream') == 'true':
+        response = stream_message(summarizer, message, bypass_cache)
+        # a streamed response ends after the request, whether the client reads it to the end or not
+        response.call_on_close(partial(release_summarizer, auth.current_user(), summarizer))
+        return response
+
+    try:
+        response = summarizer.send(message, bypass_cache=bypass_cache)
+    finally:
+        release_summarizer(auth.current_user(), summarizer)
+    return jsonify({"response": response, "cached": summarizer.cached})
+
+def stream_message(summarizer, message, bypass_cache=False):
+    def generate():
+        try:
+            for chunk in summarizer.send_stream(message, bypass_cache=bypass_cache):
+                yield f"data: {json.dumps({'text': chunk})}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        else:
+            yield f"event: done\ndata: {json.dumps({'cached': summarizer.cached})}\n\n"
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
 
 @app.route('/conversations/<conversation_id>/json', methods=['GET'])
 @auth.login_required
 def get_conversation_json(conversation_id):
-    summarizer = get_summarizer(conversation_id)
+    summarizer = get_record(conversation_id, last=request.args.get('last', type=int))
     if not summarizer:
         return jsonify({"error": "Conversation not found"}), 404
     
@@ -141,7 +237,7 @@ def get_conversation_json(conversation_id):
 @app.route('/conversations/<conversation_id>/markdown', methods=['GET'])
 @auth.login_required
 def get_conversation_markdown(conversation_id):
-    summarizer = get_summarizer(conversation_id)
+    summarizer = get_record(conversation_id, last=request.args.get('last', type=int))
     if not summarizer:
         return jsonify({"error": "Conversation not found"}), 404
     
@@ -166,10 +262,25 @@ def favicon():
 def statics(filename):
     return send_from_directory('statics/', filename)
 
+@app.route('/sessions/stats', methods=['GET'])
+@auth.login_required
+def session_stats():
+    return jsonify(active_conversations.dict), 200
+
+@app.route('/rate_limits/stats', methods=['GET'])
+@auth.login_required
+def rate_limits_stats():
+    return jsonify(rate_limit_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+@auth.login_required
+def prometheus_metrics():
+    rate_limits = {(provider, name): value for provider, stats in rate_limit_stats().items() for name, value in stats.items()}
+    text = metrics.render(metrics.gauges('summarizer_rate_limit', 'Rate limiter counters per provider.', ('provider', 'stat'), rate_limits))
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 def save_active_conversations():
-    for db in active_conversations:
-        for summarizer in active_conversations[db].values():
-            summarizer.save()
+    active_conversations.save_all()
 
 atexit.register(save_active_conversations)
 
@@ -0,0 +1,237 @@
+"""
+In-process stand-ins for the services the summarizer talks to, on one local HTTP server:
+
+    /upload/v1beta/files, /v1beta/files/*     Gemini File API (resumable upload, get)
+    /v1beta/models/*:generateContent          Gemini generate, streamGenerateContent and countTokens (REST)
+    /jina/                                    r.jina.ai
+    /marker                                   marker-api
+    /asr                                      whisper-asr-webservice
+    /files/*                                  any document, a fake pdf for *.pdf
+
+Every route sleeps for its configured latency (+-20% jitter) and fails with `failure_status` at `failure_rate`.
+
+    python benchmarks/fake_services.py --port 8081 --latency generate=2 jina=0.5
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# seconds; stream_chunk is the delay between streamed chunks, activation how long uploads stay PROCESSING
+LATENCY = {'upload': 0.05, 'files': 0.01, 'generate': 0.5, 'stream_chunk': 0.05, 'count_tokens': 0.02,
+           'jina': 0.3, 'marker': 1.0, 'asr': 0.5, 'download': 0.05, 'activation': 0}
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+def filler(words, seed=None):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+class FakeServices:
+    def __init__(self, host='127.0.0.1', port=0, latency=None, failure_rate=0.0, failure_status=503,
+                 document_words=2000, response_words=300, stream_chunks=10):
+        self.latency = dict(LATENCY, **(latency or {}))
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.document_words = document_words
+        self.response_words = response_words
+        self.stream_chunks = stream_chunks
+        self.files = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, route):
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def delay(self, route):
+        seconds = self.latency.get(route, 0)
+        if seconds:
+            time.sleep(seconds * random.uniform(0.8, 1.2))
+
+    def file_resource(self, file_id):
+        file = self.files[file_id]
+        state = 'ACTIVE' if time.monotonic() >= file['ready'] else 'PROCESSING'
+        return {'name': f'files/{file_id}', 'displayName': file['display_name'], 'mimeType': file['mime_type'],
+                'sizeBytes': str(file['size']), 'uri': f'{self.url}/v1beta/files/{file_id}', 'state': state,
+                'createTime': '2024-01-01T00:00:00Z', 'updateTime': '2024-01-01T00:00:00Z',
+                'expirationTime': '2099-01-01T00:00:00Z', 'sha256Hash': ''}
+
+    def candidate(self, text):
+        return {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}],
+                'usageMetadata': {'promptTokenCount': 0, 'candidatesTokenCount': len(text) // 4}}
+
+    def handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, data, status=200, headers={}):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def route(self, route):
+                services.count(route)
+                services.delay(route)
+                if random.random() < services.failure_rate:
+                    self.send_json({'error': {'code': services.failure_status, 'message': 'injected failure'}},
+                                   status=services.failure_status, headers={'Retry-After': '1'})
+                    return False
+                return True
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                self.read_body()
+                match = re.fullmatch(r'/v1beta/files/([\w-]+)', path)
+                if match:
+                    if not self.route('files'):
+                        return
+                    if match.group(1) not in services.files:
+                        return self.send_json({'error': {'code': 404, 'message': 'not found'}}, status=404)
+                    return self.send_json(services.file_resource(match.group(1)))
+                if path.startswith('/files/'):
+                    if not self.route('download'):
+                        return
+                    body = b'%PDF-1.4\n' + filler(services.document_words, path).encode() if path.endswith('.pdf') \
+                        else f"<html><body><p>{filler(services.document_words, path)}</p></body></html>".encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/pdf' if path.endswith('.pdf') else 'text/html')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    return self.wfile.write(body)
+                self.send_json({'error': {'code': 404, 'message': path}}, status=404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                path, query = url.path, parse_qs(url.query)
+                body = self.read_body()
+                if path == '/upload/v1beta/files' and 'upload_id' not in query:
+                    if not self.route('upload'):
+                        return
+                    metadata = json.loads(body or b'{}').get('file', {})
+                    with services.lock:
+                        file_id = f"{len(services.files):08d}{random.getrandbits(32):08x}"
+                        services.files[file_id] = {'display_name': metadata.get('display_name', file_id), 'size': 0,
+                                                   'mime_type': self.headers.get('X-Goog-Upload-Header-Content-Type', 'text/plain'),
+                                                   'ready': float('inf')}
+                    self.send_response(200)
+                    self.send_header('X-Goog-Upload-URL', f'{services.url}/upload/v1beta/files?upload_id={file_id}')
+                    self.send_header('Content-Length', '0')
+                    return self.end_headers()
+                if path == '/upload/v1beta/files':
+                    file_id = query['upload_id'][0]
+                    services.files[file_id].update(size=len(body), ready=time.monotonic() + services.latency['activation'])
+                    return self.send_json({'file': services.file_resource(file_id)})
+                match = re.fullmatch(r'/v1beta/models/[\w.-]+:(\w+)', path)
+                if match and match.group(1) == 'countTokens':
+                    if not self.route('count_tokens'):
+                        return
+                    return self.send_json({'totalTokens': max(len(body) // 4, 1)})
+                if match and match.group(1) == 'generateContent':
+                    if not self.route('generate'):
+                        return
+                    return self.send_json(services.candidate(filler(services.response_words)))
+                if match and match.group(1) == 'streamGenerateContent':
+                    if not self.route('generate'):
+                        return
+                    return self.stream(filler(services.response_words))
+                if path.rstrip('/') == '/jina':
+                    if not self.route('jina'):
+                        return
+                    target = parse_qs(body.decode()).get('url', [''])[0]
+                    return self.send_json({'data': {'title': f'page {abs(hash(target)) % 10 ** 8}', 'url': target,
+                                                    'content': f"# {target}\n\n{filler(services.document_words, target)}"}})
+                if path == '/marker':
+                    if not self.route('marker'):
+                        return
+                    return self.send_json({'markdown': f"# document\n\n{filler(services.document_words, len(body))}"})
+                if path == '/asr':
+                    if not self.route('asr'):
+                        return
+                    segments = [{'start': i * 5.0, 'end': i * 5.0 + 4.5, 'text': filler(12)} for i in range(120)]
+                    return self.send_json({'text': '', 'segments': segments})
+                self.send_json({'error': {'code': 404, 'message': path}}, status=404)
+
+            def stream(self, text):
+                # a JSON array written piece by piece, which is what the REST transport parses
+                words = text.split(' ')
+                size = -(-len(words) // services.stream_chunks)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for i in range(0, len(words), size):
+                    if i:
+                        services.delay('stream_chunk')
+                    piece = ('[' if i == 0 else ',') + json.dumps(services.candidate(' '.join(words[i:i + size]) + ' '))
+                    self.write_chunk(piece.encode())
+                self.write_chunk(b']')
+                self.write_chunk(b'')
+
+            def write_chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+def parse_latency(values):
+    latency = {}
+    for value in values or []:
+        route, seconds = value.split('=')
+        latency[route] = float(seconds)
+    return latency
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Gemini, Jina, marker and whisper services')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', nargs='*', help=f'route=seconds, routes: {", ".join(LATENCY)}')
+    parser.add_argument('--failure_rate', type=float, default=0.0)
+    parser.add_argument('--failure_status', type=int, default=503)
+    args = parser.parse_args()
+
+    services = FakeServices(args.host, args.port, parse_latency(args.latency), args.failure_rate, args.failure_status)
+    print(f"Serving on {services.url}")
+    print(f"GEMINI_API_BASE={services.url} JINA_API_URL={services.url}/jina/ MARKER_API_URL={services.url}/marker "
+          f"WHISPER_ASR_API_URL={services.url}/asr")
+    try:
+        services.server.serve_forever()
+    except KeyboardInterrupt:
+        services.server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Drive GeminiSummarizer and the Flask app under concurrent load against benchmarks/fake_services.py, and report
+latency percentiles, throughput and memory. Runs offline in a scratch directory, nothing touches db/.
+
+    python benchmarks/load_benchmark.py summarize --requests 40 --concurrency 8 --urls 3
+    python benchmarks/load_benchmark.py chat --requests 100 --concurrency 16 --stream
+    python benchmarks/load_benchmark.py pdf asr --latency marker=0.2 asr=0.2 --failure_rate 0.05 --failure_status 429
+
+Scenarios:
+    summarize   GeminiSummarizer over jina-scraped urls, one question, save
+    chat        POST /conversations then follow-up messages through the Flask test client
+    pdf         download_pdf with marker conversion
+    asr         transcriber.transcribe on generated audio (needs ffmpeg), whisper_asr_segments otherwise
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import uuid
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_services import FakeServices, parse_latency
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def time(self, operation, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            with self.lock:
+                self.errors.setdefault(operation, []).append(str(e))
+            raise
+        finally:
+            with self.lock:
+                self.timings.setdefault(operation, []).append(time.perf_counter() - start)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def configure_environment(services, workdir, args):
+    """
+    Point every client at the fake services. Must run before the repo modules are imported, they read their
+    settings at import time.
+    """
+    os.environ.update({
+        'GEMINI_API_KEY': 'benchmark', 'GEMINI_API_BASE': services.url,
+        'JINA_API_URL': f'{services.url}/jina/', 'JINA_API_KEY': '',
+        'MARKER_API_URL': f'{services.url}/marker', 'WHISPER_ASR_API_URL': f'{services.url}/asr', 'GROQ_API_KEY': '',
+        'DOWNLOADER_FOLDER': workdir + '/',
+        # the generated pages are small enough to be sent inline, which would skip the uploads and their polling
+        'INLINE_TEXT_MAX_BYTES': str(args.inline_text_max_bytes),
+    })
+    # the fake services are the limit being measured, not the client-side rate limits
+    for provider in ('GEMINI', 'JINA', 'FIRECRAWL', 'GROQ'):
+        os.environ.setdefault(f'{provider}_RPM', str(args.rpm))
+
+def run_concurrently(recorder, scenario, requests, concurrency):
+    def run(i):
+        try:
+            recorder.time('total', scenario, i, recorder)
+        except Exception:
+            pass
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, range(requests)))
+    return time.perf_counter() - start
+
+def summarize_scenario(args, services):
+    from Summarize import GeminiSummarizer
+
+    def scenario(i, recorder):
+        urls = [f'{services.url}/files/page-{uuid.uuid4().hex}.html' for _ in range(args.urls)]
+        summarizer = recorder.time('create', GeminiSummarizer, urls=urls, model=args.model, scraper='jina',
+                                   db='benchmark', map_reduce=args.map_reduce)
+        recorder.time('send', summarizer.send, 'summarize')
+        recorder.time('save', summarizer.save)
+    return scenario
+
+def chat_scenario(args, services):
+    import app as flask_app
+    token = next(iter(flask_app.tokens))
+    headers = {'Authorization': f'Bearer {token}'}
+
+    def scenario(i, recorder):
+        client = flask_app.app.test_client()
+        urls = [f'{services.url}/files/page-{uuid.uuid4().hex}.html' for _ in range(args.urls)]
+        response = recorder.time('create', client.post, '/conversations', headers=headers,
+                                 json={'urls': urls, 'model': args.model, 'map_reduce': args.map_reduce})
+        if response.status_code != 201:
+            raise Exception(f"create {response.status_code}: {response.get_data(as_text=True)}")
+        conversation_id = response.get_json()['conversation_id']
+        for _ in range(args.messages):
+            response = recorder.time('message', client.post, f'/conversations/{conversation_id}/messages',
+                                     headers=headers, json={'message': 'and then?', 'stream': args.stream})
+            # a streamed body is only produced while it's read
+            body = response.get_data(as_text=True)
+            if response.status_code != 200 or 'event: error' in body:
+                raise Exception(f"message {response.status_code}: {body[:200]}")
+        recorder.time('get', client.get, f'/conversations/{conversation_id}/markdown', headers=headers)
+    return scenario
+
+def pdf_scenario(args, services):
+    from scraper import download_pdf
+
+    def scenario(i, recorder):
+        recorder.time('pdf', download_pdf, f'{services.url}/files/{uuid.uuid4().hex}.pdf', True)
+    return scenario
+
+def asr_scenario(args, services):
+    import transcriber
+    if shutil.which(transcriber.FFMPEG):
+        audio_file = os.path.join(os.getcwd(), 'tone.mp3')
+        subprocess.run([transcriber.FFMPEG, '-loglevel', 'error', '-y', '-f', 'lavfi', '-i',
+                        f'sine=frequency=440:duration={args.audio_minutes * 60}', '-ac', '1', audio_file], check=True)
+
+        def scenario(i, recorder):
+            recorder.time('transcribe', transcriber.transcribe, audio_file)
+    else:
+        print("ffmpeg not found, timing single whisper requests instead of chunked transcription")
+        audio_file = os.path.join(os.getcwd(), 'audio.mp3')
+        with open(audio_file, 'wb') as f:
+            f.write(os.urandom(1024 * 1024))
+
+        def scenario(i, recorder):
+            recorder.time('whisper', transcriber.whisper_asr_segments, audio_file)
+    return scenario
+
+SCENARIOS = {'summarize': summarize_scenario, 'chat': chat_scenario, 'pdf': pdf_scenario, 'asr': asr_scenario}
+
+def report(name, recorder, elapsed, requests, services):
+    result = {'scenario': name, 'requests': requests, 'seconds': round(elapsed, 3),
+              'throughput': round(requests / elapsed, 2), 'operations': {}, 'service_calls': dict(services.counts)}
+    for operation, values in recorder.timings.items():
+        result['operations'][operation] = {'count': len(values), 'errors': len(recorder.errors.get(operation, [])),
+                                           'p50': round(percentile(values, 0.5), 4), 'p99': round(percentile(values, 0.99), 4),
+                                           'max': round(max(values), 4)}
+    return result
+
+def print_report(result):
+    print(f"\n{result['scenario']}: {result['requests']} requests in {result['seconds']}s, {result['throughput']} req/s")
+    print(f"  {'operation':<12}{'count':>7}{'errors':>8}{'p50':>10}{'p99':>10}{'max':>10}")
+    for operation, stats in result['operations'].items():
+        print(f"  {operation:<12}{stats['count']:>7}{stats['errors']:>8}{stats['p50']:>10.3f}{stats['p99']:>10.3f}{stats['max']:>10.3f}")
+    print(f"  service calls: {result['service_calls']}")
+    print(f"  peak rss: {result['peak_rss_mb']} MB" + (f", traced peak: {result['traced_peak_mb']} MB" if 'traced_peak_mb' in result else ''))
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load benchmark against fake Gemini, Jina, marker and whisper services')
+    parser.add_argument('scenarios', nargs='+', choices=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--urls', type=int, default=2, help='urls per conversation')
+    parser.add_argument('--messages', type=int, default=2, help='follow-up messages per conversation (chat)')
+    parser.add_argument('--stream', action='store_true', help='stream the follow-ups (chat)')
+    parser.add_argument('--map_reduce', action='store_true')
+    parser.add_argument('--model', default='models/gemini-1.5-flash')
+    parser.add_argument('--audio_minutes', type=int, default=30, help='length of the generated audio (asr)')
+    parser.add_argument('--latency', nargs='*', help='route=seconds, see fake_services.py')
+    parser.add_argument('--failure_rate', type=float, default=0.0)
+    parser.add_argument('--failure_status', type=int, default=503)
+    parser.add_argument('--document_words', type=int, default=2000)
+    parser.add_argument('--inline_text_max_bytes', type=int, default=0,
+                        help='pages up to this size are sent inline instead of uploaded, 0 uploads every page')
+    parser.add_argument('--rpm', type=int, default=0, help='client-side rate limit per provider, 0 for none')
+    parser.add_argument('--tracemalloc', action='store_true', help='also trace Python allocations (slower)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+    json_file = os.path.abspath(args.json) if args.json else None
+
+    services = FakeServices(latency=parse_latency(args.latency), failure_rate=args.failure_rate,
+                            failure_status=args.failure_status, document_words=args.document_words).start()
+    workdir = tempfile.mkdtemp(prefix='summarizer-benchmark-')
+    os.makedirs(os.path.join(workdir, 'db'))
+    configure_environment(services, workdir, args)
+    # the app resolves templates from its own path, the dbs and downloads land in the scratch directory
+    os.chdir(workdir)
+    import gemini_client
+    gemini_client.configure()
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    results = []
+    try:
+        for name in args.scenarios:
+            scenario = SCENARIOS[name](args, services)
+            services.counts.clear()
+            recorder = Recorder()
+            elapsed = run_concurrently(recorder, scenario, args.requests, args.concurrency)
+            result = report(name, recorder, elapsed, args.requests, services)
+            result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+            if args.tracemalloc:
+                result['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+                tracemalloc.reset_peak()
+            for operation, errors in recorder.errors.items():
+                print(f"{operation} errors, first: {errors[0]}")
+            results.append(result)
+    finally:
+        services.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in results:
+        print_report(result)
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+srt_to_txt before and after the subtitles parser, on a synthetic YouTube auto-caption track.
+
+    python benchmarks/subtitles_benchmark.py --hours 3
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from subtitles import subtitles_to_text
+
+WORDS = "the of and to in is you that it he was for on are as with his they at be this have from or one had by word but not what all were we when your can said there use an each which she do how their if will up other about out many then them these so some her would make like him into time has look two more write go see number no way could people my than first water been call who oil its now find long down day did get come made may part".split()
+
+def legacy_srt_to_txt(srt_file_path, txt_file_path):
+    # the line-by-line implementation srt_to_txt used to have
+    timestamp_pattern = re.compile(r'\d+:\d+:\d+,\d+ --> \d+:\d+:\d+,\d+')
+    with open(srt_file_path, 'r', encoding='utf-8') as srt_file, \
+         open(txt_file_path, 'w', encoding='utf-8') as txt_file:
+        skip_next = False
+        for line in srt_file:
+            line = line.strip()
+            if not line or line.isdigit():
+                continue
+            if timestamp_pattern.match(line) or skip_next:
+                skip_next = False
+                continue
+            txt_file.write(line + ' ')
+            if line.endswith('>'):
+                skip_next = True
+
+def timestamp(seconds, separator):
+    hours, rest = divmod(seconds, 3600)
+    minutes, rest = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{rest:06.3f}".replace('.', separator)
+
+def auto_captions(hours):
+    """
+    The rolling layout of YouTube auto-captions: each line shows up with word timings, again in a 10ms cue, then
+    as the first line of the next cue. Returns the (vtt, srt) pair, srt being what FFmpegSubtitlesConvertor makes of it.
+    """
+    random.seed(0)
+    vtt, srt = ["WEBVTT\nKind: captions\nLanguage: en\n"], []
+    previous, t, n = "", 0.0, 0
+    while t < hours * 3600:
+        words = random.choices(WORDS, k=random.randint(5, 9))
+        line = " ".join(words)
+        timed = words[0] + "".join(f"<{timestamp(t + i * 0.3, '.')}><c> {word}</c>" for i, word in enumerate(words[1:], 1))
+        for start, end, text, plain in [(t, t + 3, f"{previous}\n{timed}", f"{previous}\n{line}"),
+                                        (t + 3, t + 3.01, f"{line}\n ", line)]:
+            n += 1
+            vtt.append(f"{timestamp(start, '.')} --> {timestamp(end, '.')} align:start position:0%\n{text.strip(chr(10))}\n")
+            srt.append(f"{n}\n{timestamp(start, ',')} --> {timestamp(end, ',')}\n{plain.strip()}\n")
+        previous, t = line, t + 3.01
+    return "\n".join(vtt), "\n".join(srt)
+
+def measure(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark subtitle to text conversion')
+    parser.add_argument('--hours', type=float, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    vtt, srt = auto_captions(args.hours)
+    with tempfile.TemporaryDirectory() as directory:
+        srt_file = os.path.join(directory, 'captions.srt')
+        txt_file = os.path.join(directory, 'captions.txt')
+        with open(srt_file, 'w', encoding='utf-8') as f:
+            f.write(srt)
+
+        def legacy():
+            legacy_srt_to_txt(srt_file, txt_file)
+            with open(txt_file, encoding='utf-8') as f:
+                return f.read()
+
+        vtt_file = os.path.join(directory, 'captions.vtt')
+        with open(vtt_file, 'w', encoding='utf-8') as f:
+            f.write(vtt)
+
+        def legacy_with_ffmpeg():
+            # what the .txt path used to cost: FFmpegSubtitlesConvertor, then srt_to_txt
+            subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-i', vtt_file, srt_file], check=True)
+            return legacy()
+
+        cases = [
+            ('legacy srt_to_txt (srt)', legacy),
+            ('subtitles_to_text (srt)', lambda: subtitles_to_text(srt, rolling=True)),
+            ('subtitles_to_text (vtt)', lambda: subtitles_to_text(vtt.encode(), rolling=True)),
+            ('subtitles_to_text (vtt, 60s timestamps)', lambda: subtitles_to_text(vtt.encode(), 60, rolling=True)),
+        ]
+        if shutil.which('ffmpeg'):
+            cases.insert(1, ('ffmpeg vtt->srt + legacy srt_to_txt', legacy_with_ffmpeg))
+        print(f"{args.hours}h of auto-captions: srt {len(srt) / 1e6:.1f}MB, vtt {len(vtt) / 1e6:.1f}MB")
+        for name, func in cases:
+            seconds, text = measure(func, args.repeat)
+            print(f"{name:42s} {seconds * 1000:8.1f} ms {len(text):>10,d} chars")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import Column, String, DateTime, Text, Integer, func
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import sessionmaker
+from storage import build_engine
+
+CacheBase = declarative_base()
+CACHE_DB = os.getenv('CACHE_DB', 'sqlite:///db/cache.db')
+# Gemini files expire after 48h, don't hand out handles that are about to die
+UPLOAD_CACHE_MARGIN = int(os.getenv('UPLOAD_CACHE_MARGIN', 3600))
+SCRAPE_CACHE_TTL = int(os.getenv('SCRAPE_CACHE_TTL', 86400))
+# expired results are kept this long for their ETag/Last-Modified, then pruned
+SCRAPE_CACHE_KEEP = int(os.getenv('SCRAPE_CACHE_KEEP', 7 * 86400))
+# captions and transcripts of a published video don't change
+TRANSCRIPT_CACHE_TTL = int(os.getenv('TRANSCRIPT_CACHE_TTL', 30 * 86400))
+# extract_info fields worth keeping, formats and caption urls expire within hours
+VIDEO_INFO_FIELDS = ['id', 'extractor_key', 'title', 'duration', 'uploader', 'upload_date', 'webpage_url']
+# opt-in: answers to the first question about the same sources, shared by every token db
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'false').lower() == 'true'
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 7 * 86400))
+# least recently used answers are evicted past this many bytes
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+cache_engine = build_engine(CACHE_DB)
+CacheSession = sessionmaker(bind=cache_engine)
+
+class UploadedFile(CacheBase):
+    __tablename__ = 'uploaded_files'
+
+    sha256 = Column(String, primary_key=True)
+    mime_type = Column(String, primary_key=True)
+    name = Column(String)
+    uri = Column(String)
+    expiration_time = Column(DateTime)
+
+class ScrapeResult(CacheBase):
+    __tablename__ = 'scrape_results'
+
+    key = Column(String, primary_key=True)
+    url = Column(String)
+    scraper = Column(String)
+    title = Column(String)
+    markdown = Column(Text)
+    etag = Column(String)
+    last_modified = Column(String)
+    expires = Column(DateTime)
+
+class VideoInfo(CacheBase):
+    __tablename__ = 'video_info'
+
+    extractor = Column(String, primary_key=True)
+    video_id = Column(String, primary_key=True)
+    url = Column(String, index=True)
+    title = Column(String)
+    info = Column(Text)
+    updated = Column(DateTime)
+
+class Transcript(CacheBase):
+    __tablename__ = 'transcripts'
+
+    extractor = Column(String, primary_key=True)
+    video_id = Column(String, primary_key=True)
+    # the requested language, '' when the best available one was picked
+    language = Column(String, primary_key=True)
+    format = Column(String, primary_key=True)
+    path = Column(String)
+    # None for downloaded audio, which is only reused while the file is still there
+    content = Column(Text)
+    source = Column(String)
+    expires = Column(DateTime)
+
+class CachedResponse(CacheBase):
+    __tablename__ = 'cached_responses'
+
+    key = Column(String, primary_key=True)
+    model = Column(String)
+    response = Column(Text)
+    size = Column(Integer)
+    hits = Column(Integer, default=0)
+    expires = Column(DateTime)
+    last_used = Column(DateTime, index=True)
+
+CacheBase.metadata.create_all(cache_engine)
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def file_sha256(filename, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_uploaded_file(sha256, mime_type):
+    session = CacheSession()
+    try:
+        cached = session.get(UploadedFile, (sha256, mime_type))
+        if cached and cached.expiration_time > utcnow() + timedelta(seconds=UPLOAD_CACHE_MARGIN):
+            return cached.name
+        return None
+    finally:
+        session.close()
+
+def put_uploaded_file(sha256, mime_type, uploaded_file):
+    expiration_time = uploaded_file.expiration_time
+    if expiration_time.tzinfo:
+        expiration_time = expiration_time.astimezone(timezone.utc).replace(tzinfo=None)
+    session = CacheSession()
+    try:
+        session.merge(UploadedFile(sha256=sha256, mime_type=mime_type, name=uploaded_file.name,
+                                   uri=uploaded_file.uri, expiration_time=expiration_time))
+        session.commit()
+    finally:
+        session.close()
+
+def drop_uploaded_file(sha256, mime_type):
+    session = CacheSession()
+    try:
+        session.query(UploadedFile).filter_by(sha256=sha256, mime_type=mime_type).delete()
+        session.commit()
+    finally:
+        session.close()
+
+def scrape_key(url, scraper, options):
+    return hashlib.sha256(json.dumps([url, scraper, options], sort_keys=True, default=str).encode()).hexdigest()
+
+def get_scrape_result(key):
+    session = CacheSession()
+    try:
+        return session.get(ScrapeResult, key)
+    finally:
+        session.close()
+
+def put_scrape_result(key, url, scraper, title, markdown, etag=None, last_modified=None):
+    session = CacheSession()
+    try:
+        session.merge(ScrapeResult(key=key, url=url, scraper=scraper, title=title, markdown=markdown, etag=etag,
+                                   last_modified=last_modified, expires=utcnow() + timedelta(seconds=SCRAPE_CACHE_TTL)))
+        session.query(ScrapeResult).filter(ScrapeResult.expires < utcnow() - timedelta(seconds=SCRAPE_CACHE_KEEP)).delete()
+        session.commit()
+    finally:
+        session.close()
+
+def refresh_scrape_result(key):
+    session = CacheSession()
+    try:
+        session.query(ScrapeResult).filter_by(key=key).update({'expires': utcnow() + timedelta(seconds=SCRAPE_CACHE_TTL)})
+        session.commit()
+    finally:
+        session.close()
+
+def find_video(url):
+    """
+    (extractor, video_id) of a url seen before, for urls the id can't be parsed from (short links).
+    """
+    session = CacheSession()
+    try:
+        cached = session.query(VideoInfo).filter_by(url=url).first()
+        return (cached.extractor, cached.video_id) if cached else None
+    finally:
+        session.close()
+
+def put_video_info(extractor, video_id, url, info):
+    record = {field: info.get(field) for field in VIDEO_INFO_FIELDS}
+    record['subtitles'] = sorted(info.get('subtitles') or {})
+    record['automatic_captions'] = sorted(info.get('automatic_captions') or {})
+    session = CacheSession()
+    try:
+        session.merge(VideoInfo(extractor=extractor, video_id=video_id, url=url, title=info.get('title'),
+                                info=json.dumps(record), updated=utcnow()))
+        session.commit()
+    finally:
+        session.close()
+
+def get_transcript(extractor, video_id, language, format):
+    """
+    Path of the cached captions/transcript, rewritten from the stored content if the file is gone.
+    """
+    session = CacheSession()
+    try:
+        cached = session.get(Transcript, (extractor, video_id, language or '', format))
+        if not cached or cached.expires < utcnow():
+            return None
+        if not os.path.exists(cached.path):
+            if cached.content is None:
+                return None
+            os.makedirs(os.path.dirname(cached.path) or '.', exist_ok=True)
+            with open(cached.path, 'w', encoding='utf-8') as f:
+                f.write(cached.content)
+        return cached.path
+    finally:
+        session.close()
+
+def put_transcript(extractor, video_id, language, format, path, source):
+    content = None
+    if source != 'audio':
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+    session = CacheSession()
+    try:
+        session.merge(Transcript(extractor=extractor, video_id=video_id, language=language or '', format=format, path=path,
+                                 content=content, source=source, expires=utcnow() + timedelta(seconds=TRANSCRIPT_CACHE_TTL)))
+        session.query(Transcript).filter(Transcript.expires < utcnow()).delete()
+        session.commit()
+    finally:
+        session.close()
+
+def response_key(source_hashes, prompt, model):
+    """
+    Same sources in any order, same prompt up to whitespace, same model.
+    """
+    prompt = ' '.join(prompt.split())
+    return hashlib.sha256(json.dumps([sorted(source_hashes), prompt, model]).encode()).hexdigest()
+
+def get_cached_response(key):
+    session = CacheSession()
+    try:
+        cached = session.get(CachedResponse, key)
+        if not cached or cached.expires < utcnow():
+            return None
+        cached.hits += 1
+        cached.last_used = utcnow()
+        session.commit()
+        return cached.response
+    finally:
+        session.close()
+
+def put_cached_response(key, model, response):
+    session = CacheSession()
+    try:
+        size = len(response.encode())
+        session.merge(CachedResponse(key=key, model=model, response=response, size=size, hits=0,
+                                     expires=utcnow() + timedelta(seconds=RESPONSE_CACHE_TTL), last_used=utcnow()))
+        session.query(CachedResponse).filter(CachedResponse.expires < utcnow()).delete()
+        excess = (session.query(func.sum(CachedResponse.size)).scalar() or 0) - RESPONSE_CACHE_MAX_BYTES
+        if excess > 0:
+            evicted = []
+            for old_key, old_size in session.query(CachedResponse.key, CachedResponse.size).order_by(CachedResponse.last_used):
+                if excess <= 0:
+                    break
+                evicted.append(old_key)
+                excess -= old_size
+            session.query(CachedResponse).filter(CachedResponse.key.in_(evicted)).delete()
+        session.commit()
+    finally:
+        session.close()
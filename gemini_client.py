@@ -0,0 +1,108 @@
+import os
+from datetime import timedelta
+import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core.exceptions import NotFound, PermissionDenied
+from http_client import build_session
+from rate_limit import rate_limited_call, check_response
+
+GEMINI_PROXY = os.getenv('GEMINI_PROXY', '')
+DEFAULT_API_BASE = 'https://generativelanguage.googleapis.com'
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', DEFAULT_API_BASE)
+GEMINI_UPLOAD_TIMEOUT = int(os.getenv('GEMINI_UPLOAD_TIMEOUT', 600))
+
+# uploads stream the file as the request body, so they can't be retried transparently
+gemini_session = build_session(timeout=GEMINI_UPLOAD_TIMEOUT, retries=0, proxy=GEMINI_PROXY)
+gemini_config = {'api_key': None}
+
+def configure(api_key=None):
+    """
+    Configure genai once at startup, before any thread talks to Gemini.
+    """
+    api_key = api_key or os.getenv('GEMINI_API_KEY')
+    if GEMINI_PROXY:
+        # only grpc reads grpc_proxy: the genai channel goes through GEMINI_PROXY while requests, yt-dlp and groq
+        # keep using http_proxy/https_proxy
+        os.environ['grpc_proxy'] = GEMINI_PROXY
+    if GEMINI_API_BASE != DEFAULT_API_BASE:
+        # a gateway or a local stand-in: the grpc channel can't be pointed at a plain http base, go through REST
+        genai.configure(api_key=api_key, transport='rest', client_options={'api_endpoint': GEMINI_API_BASE})
+    else:
+        genai.configure(api_key=api_key)
+    gemini_config['api_key'] = api_key
+
+def gemini_call(func, *args, **kwargs):
+    """
+    Call the Gemini API under the rate limit of the configured key.
+    """
+    return rate_limited_call('gemini', func, *args, key=gemini_config['api_key'], **kwargs)
+
+def upload_file(path, mime_type, display_name=None):
+    # fetched apart, a 429 on the get must not send the whole file again
+    return get_file(gemini_call(resumable_upload, path, mime_type, display_name))
+
+def get_file(name):
+    return gemini_call(genai.get_file, name)
+
+def resumable_upload(path, mime_type, display_name=None):
+    """
+    Upload through the File API's resumable protocol on gemini_session, returning the file's name. genai.upload_file
+    shares one httplib2 connection between threads and only follows the process-wide proxy settings.
+    """
+    size = os.path.getsize(path)
+    response = gemini_session.post(f"{GEMINI_API_BASE}/upload/v1beta/files", params={'key': gemini_config['api_key']},
+                                   headers={'X-Goog-Upload-Protocol': 'resumable',
+                                            'X-Goog-Upload-Command': 'start',
+                                            'X-Goog-Upload-Header-Content-Length': str(size),
+                                            'X-Goog-Upload-Header-Content-Type': mime_type},
+                                   json={'file': {'display_name': display_name or path}})
+    check_response(response).raise_for_status()
+    upload_url = response.headers['X-Goog-Upload-URL']
+    with open(path, 'rb') as f:
+        response = gemini_session.post(upload_url, data=f,
+                                       headers={'Content-Length': str(size),
+                                                'X-Goog-Upload-Offset': '0',
+                                                'X-Goog-Upload-Command': 'upload, finalize'})
+    check_response(response).raise_for_status()
+    return response.json()['file']['name']
+
+class CachedPrefixModel:
+    """
+    Stands in for the GenerativeModel of a ChatSession whose first `turns` history entries live in a context
+    cache: requests leave them out and run against the cache. If the cache is gone (expired early, deleted), the
+    request is sent again with the full history and `on_miss` is called so the cache gets re-created.
+    """
+    def __init__(self, model, cached_content, turns, safety_settings=None, on_miss=None):
+        self.model = model
+        self.cache_name = cached_content if isinstance(cached_content, str) else cached_content.name
+        # with a name, from_cached_content gets the cache first
+        self.cached_model = gemini_call(genai.GenerativeModel.from_cached_content, cached_content, safety_settings=safety_settings)
+        self.turns = turns
+        self.on_miss = on_miss
+
+    def generate_content(self, contents, **kwargs):
+        try:
+            return self.cached_model.generate_content(contents[self.turns:], **kwargs)
+        except (NotFound, PermissionDenied) as e:
+            print(f"Context cache unavailable, sending the full history: {e}")
+            if self.on_miss:
+                self.on_miss()
+            return self.model.generate_content(contents, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+def create_context_cache(model, contents, ttl, display_name=None):
+    return caching.CachedContent.create(model=model.model_name, display_name=display_name, contents=contents,
+                                        ttl=timedelta(seconds=ttl))
+
+def extend_context_cache(name, ttl):
+    cached_content = caching.CachedContent.get(name)
+    cached_content.update(ttl=timedelta(seconds=ttl))
+    return cached_content
+
+def delete_context_cache(name):
+    try:
+        gemini_call(lambda: caching.CachedContent.get(name).delete())
+    except Exception as e:
+        print(f"Failed to delete context cache {name}: {e}")
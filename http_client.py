@@ -0,0 +1,55 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 30))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', 0.5))
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 16))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 16))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session that never sends a request without a timeout.
+    """
+    def __init__(self, timeout=HTTP_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+def build_session(timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, proxy=None, trust_env=True,
+                  retry_statuses=RETRY_STATUSES):
+    """
+    With `proxy` every request goes through it; trust_env=False ignores http_proxy/https_proxy (direct connections).
+    """
+    session = TimeoutSession(timeout)
+    if proxy:
+        # environment proxies would take precedence over session.proxies
+        session.proxies = {'http': proxy, 'https': proxy}
+        trust_env = False
+    session.trust_env = trust_env
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=retry_statuses,
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Shared by every thread: urllib3 keeps one keep-alive pool per host
+http_session = build_session()
+# for services on the local network (whisper-asr) that must bypass the system proxy
+direct_session = build_session(trust_env=False)
+# for rate-limited APIs: their 429s are left to rate_limit.py, which backs the whole provider off instead of
+# sleeping inside a slot and retrying on top of its own retries
+api_session = build_session(retry_statuses=(500, 502, 503, 504))
@@ -0,0 +1,105 @@
+import os
+import io
+import hashlib
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from http_client import http_session
+from scraper import download_path
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 8))
+# tracking pixels, spacers and icons aren't worth an upload
+IMAGE_MIN_BYTES = int(os.getenv('IMAGE_MIN_BYTES', 2048))
+IMAGE_MIN_SIDE = int(os.getenv('IMAGE_MIN_SIDE', 48))
+IMAGE_MAX_DOWNLOAD = int(os.getenv('IMAGE_MAX_DOWNLOAD', 20 * 1024 * 1024))
+# larger images are downscaled and recompressed, Gemini resizes them anyway
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 2048))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', 1024 * 1024))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+# what Gemini accepts as is, anything else is converted
+IMAGE_FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+def fetch_image(url):
+    """
+    Image bytes, None when it's too small to matter or too large to download.
+    """
+    with http_session.get(url, stream=True) as response:
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length') or 0) > IMAGE_MAX_DOWNLOAD:
+            print(f"跳过过大的图片: {url}")
+            return None
+        data = io.BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            data.write(chunk)
+            if data.tell() > IMAGE_MAX_DOWNLOAD:
+                print(f"跳过过大的图片: {url}")
+                return None
+    data = data.getvalue()
+    return data if len(data) >= IMAGE_MIN_BYTES else None
+
+def prepare_image(data):
+    """
+    (bytes, extension) ready to upload, None for icons. Raises for anything Pillow can't decode or encode.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if min(image.size) < IMAGE_MIN_SIDE:
+        return None
+    if image.format in IMAGE_FORMATS and len(data) <= IMAGE_MAX_BYTES and max(image.size) <= IMAGE_MAX_SIDE:
+        return data, IMAGE_FORMATS[image.format]
+
+    # animations keep their first frame
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        # JPEG would turn the transparent parts black
+        image.convert('RGBA').save(output, 'WEBP', quality=IMAGE_QUALITY)
+        return output.getvalue(), '.webp'
+    image.convert('RGB').save(output, 'JPEG', quality=IMAGE_QUALITY, optimize=True)
+    return output.getvalue(), '.jpg'
+
+def image_filename(url, sha256, extension):
+    # the content hash keeps same-named images from different pages apart
+    stem = os.path.splitext(os.path.basename(urlparse(url).path))[0][:40] or 'image'
+    return download_path(f"{stem}.{sha256[:12]}{extension}")
+
+def fetch_quietly(url):
+    try:
+        return fetch_image(url)
+    except Exception as e:
+        print(f"图片下载失败 {url}: {e}")
+        return None
+
+def save_image(url, sha256, data):
+    prepared = prepare_image(data)
+    if prepared is None:
+        return None
+    data, extension = prepared
+    filename = image_filename(url, sha256, extension)
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return filename
+
+def save_quietly(url, sha256, data):
+    try:
+        return save_image(url, sha256, data)
+    except Exception as e:
+        # not an image, a decompression bomb, or one Pillow can't convert
+        print(f"图片处理失败 {url}: {e}")
+        return None
+
+def download_images(urls, workers=IMAGE_WORKERS):
+    """
+    Download the images concurrently, returning the local files of the distinct ones worth uploading, in the
+    order they first appear. Same url or same content is kept once.
+    """
+    urls = list(dict.fromkeys(url for url in urls if urlparse(url).scheme in ('http', 'https')))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        images = {}
+        for url, data in zip(urls, executor.map(fetch_quietly, urls)):
+            if data is not None:
+                sha256 = hashlib.sha256(data).hexdigest()
+                images.setdefault(sha256, (url, sha256, data))
+        files = [file for file in executor.map(lambda image: save_quietly(*image), images.values()) if file]
+    print(f"图片: {len(urls)} 个链接, 上传 {len(files)} 个")
+    return files
@@ -0,0 +1,203 @@
+import os
+import json
+import uuid
+import queue
+import threading
+import traceback
+from datetime import datetime
+from sqlalchemy import Column, String, DateTime, Text, text
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import sessionmaker
+from storage import build_engine
+from metrics import start_trace, end_trace
+
+JobBase = declarative_base()
+JOBS_DB = os.getenv('JOBS_DB', 'sqlite:///db/jobs.db')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 32))
+STAGES = ['scrape', 'transcribe', 'upload', 'activate', 'map']
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+BOOT_ID = read_file('/proc/sys/kernel/random/boot_id') or ''
+
+jobs_engine = build_engine(JOBS_DB)
+JobSession = sessionmaker(bind=jobs_engine)
+
+class Job(JobBase):
+    __tablename__ = 'jobs'
+
+    id = Column(String, primary_key=True)
+    db = Column(String, index=True)
+    status = Column(String, default='queued')
+    data = Column(Text)
+    stages = Column(Text)
+    result = Column(Text)
+    error = Column(Text)
+    # process running the job, see process_owner
+    owner = Column(String)
+    created = Column(DateTime, default=datetime.now)
+    updated = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    @property
+    def dict(self):
+        return {'id': self.id, 'status': self.status, 'stages': json.loads(self.stages or '{}'),
+                'result': json.loads(self.result) if self.result else None, 'error': self.error,
+                'created': self.created, 'updated': self.updated}
+
+JobBase.metadata.create_all(jobs_engine)
+with jobs_engine.begin() as connection:
+    # create_all doesn't alter tables that already exist
+    if 'owner' not in {row[1] for row in connection.execute(text("PRAGMA table_info(jobs)"))}:
+        connection.execute(text("ALTER TABLE jobs ADD COLUMN owner VARCHAR"))
+
+job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+workers = []
+workers_lock = threading.Lock()
+
+class JobProgress:
+    """
+    Progress callback handed to GeminiSummarizer, persisted so GET /jobs/<id> can report it.
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.lock = threading.Lock()
+        self.stages = {stage: {'done': 0, 'total': 0} for stage in STAGES}
+
+    def __call__(self, stage, total=0, done=0):
+        with self.lock:
+            self.stages[stage]['total'] += total
+            self.stages[stage]['done'] += done
+            update_job(self.job_id, stages=json.dumps(self.stages))
+
+def update_job(job_id, **values):
+    session = JobSession()
+    try:
+        values['updated'] = datetime.now()
+        session.query(Job).filter_by(id=job_id).update(values)
+        session.commit()
+    finally:
+        session.close()
+
+def get_job(job_id, db=None):
+    session = JobSession()
+    try:
+        query = session.query(Job).filter_by(id=job_id)
+        if db:
+            query = query.filter_by(db=db)
+        return query.first()
+    finally:
+        session.close()
+
+def submit_job(data):
+    """
+    Persist the job and queue it, raising queue.Full when the backlog is at capacity.
+    """
+    job_id = uuid.uuid4().hex
+    session = JobSession()
+    try:
+        session.add(Job(id=job_id, db=data.get('db'), data=json.dumps(data), stages=json.dumps(JobProgress(job_id).stages)))
+        session.commit()
+        try:
+            job_queue.put_nowait(job_id)
+        except queue.Full:
+            session.query(Job).filter_by(id=job_id).delete()
+            session.commit()
+            raise
+    finally:
+        session.close()
+    return job_id
+
+def process_owner(pid):
+    """
+    Boot id, pid and start time of a running process, None when it's gone. Neither a reboot nor a reused pid
+    passes for the same owner.
+    """
+    stat = read_file(f'/proc/{pid}/stat')
+    if stat:
+        return f"{BOOT_ID}:{pid}:{stat.rsplit(')', 1)[1].split()[19]}"
+    # no /proc
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return f"{BOOT_ID}:{pid}:"
+
+def orphaned(owner):
+    return not owner or process_owner(int(owner.split(':')[1])) != owner
+
+def claim_job(job_id):
+    session = JobSession()
+    try:
+        claimed = session.query(Job).filter_by(id=job_id, status='queued').update(
+            {'status': 'running', 'owner': process_owner(os.getpid()), 'updated': datetime.now()})
+        session.commit()
+        return claimed == 1
+    finally:
+        session.close()
+
+def run_job(job_id, handler):
+    if not claim_job(job_id):
+        return
+    job = get_job(job_id)
+    print(f"Running job {job_id}")
+    trace = start_trace(job=job_id, db=job.db)
+    status = 'failed'
+    try:
+        result = handler(json.loads(job.data), JobProgress(job_id))
+        update_job(job_id, status='done', result=json.dumps(result))
+        status = 'done'
+        print(f"Job {job_id} done")
+    except Exception as e:
+        traceback.print_exc()
+        update_job(job_id, status='failed', error=str(e))
+    finally:
+        end_trace(trace, 'job', status)
+
+def worker(handler):
+    while True:
+        job_id = job_queue.get()
+        try:
+            run_job(job_id, handler)
+        finally:
+            job_queue.task_done()
+
+def requeue_jobs():
+    """
+    Queue again the jobs whose process died, every uwsgi worker calls it and must leave the others' jobs alone.
+    """
+    session = JobSession()
+    try:
+        owners = {owner for owner, in session.query(Job.owner).filter_by(status='running').distinct()}
+        for owner in filter(orphaned, owners):
+            # interrupted jobs start over
+            session.query(Job).filter_by(status='running', owner=owner).update({'status': 'queued', 'owner': None})
+        session.commit()
+        return [job.id for job in session.query(Job).filter_by(status='queued').order_by(Job.created)]
+    finally:
+        session.close()
+
+def start_workers(handler):
+    """
+    Start the worker threads once per process. Call it after uwsgi has forked, threads don't survive a fork.
+    """
+    with workers_lock:
+        if workers:
+            return
+        job_ids = requeue_jobs()
+        for _ in range(JOB_WORKERS):
+            thread = threading.Thread(target=worker, args=(handler,), daemon=True)
+            thread.start()
+            workers.append(thread)
+
+    def requeue():
+        for job_id in job_ids:
+            job_queue.put(job_id)
+    threading.Thread(target=requeue, daemon=True).start()
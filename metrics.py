@@ -0,0 +1,138 @@
+import json
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+
+# seconds, from a db read to a long transcription
+BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SPAN_LABELS = ('stage', 'scraper', 'model', 'db')
+
+class Histogram:
+    """
+    Prometheus histogram kept in process memory: every uwsgi worker reports its own, scrape them all or run
+    one worker.
+    """
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels.get(name) or '') for name in self.labels)
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.series[key] = (counts, total + seconds)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: (counts.copy(), total) for key, (counts, total) in self.series.items()}
+        for key, (counts, total) in sorted(series.items()):
+            labels = ','.join(f'{name}="{escape(value)}"' for name, value in zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines)
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+STAGE_SECONDS = Histogram('summarizer_stage_seconds', 'Time spent in each stage of a request.', SPAN_LABELS)
+REQUEST_SECONDS = Histogram('summarizer_request_seconds', 'Time to serve a request or run a job.', ('endpoint', 'status', 'db'))
+
+class Trace:
+    """
+    Span timings of one request or job, summed per stage, for the log line written when it ends.
+    """
+    def __init__(self, **labels):
+        self.labels = labels
+        self.spans = {}
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            count, total = self.spans.get(stage, (0, 0.0))
+            self.spans[stage] = (count + 1, total + seconds)
+
+    def breakdown(self):
+        with self.lock:
+            return {stage: {'count': count, 'seconds': round(total, 3)} for stage, (count, total) in self.spans.items()}
+
+    def log(self, **fields):
+        spans = self.breakdown()
+        fields = {name: value for name, value in fields.items() if value is not None}
+        record = dict(self.labels, **fields, seconds=round(time.monotonic() - self.start, 3), spans=spans)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def start_trace(**labels):
+    trace = Trace(**labels)
+    current_trace.set(trace)
+    return trace
+
+def end_trace(trace, endpoint, status, **fields):
+    """
+    Record the request duration and write the trace's log line.
+    """
+    # cleared rather than reset: a streamed response ends in the generator's context, not the one it started in
+    current_trace.set(None)
+    REQUEST_SECONDS.observe(time.monotonic() - trace.start, endpoint=endpoint, status=status, db=trace.labels.get('db'))
+    trace.log(endpoint=endpoint, status=status, **fields)
+
+def set_trace_labels(**labels):
+    """
+    Set labels on the current trace, for the spans recorded further down that don't know them.
+    """
+    trace = current_trace.get()
+    if trace:
+        trace.labels.update({name: value for name, value in labels.items() if value})
+
+def observe(stage, seconds, **labels):
+    trace = current_trace.get()
+    if trace:
+        labels = dict({name: trace.labels.get(name) for name in SPAN_LABELS[1:]}, **{k: v for k, v in labels.items() if v})
+        trace.add(stage, seconds)
+    STAGE_SECONDS.observe(seconds, stage=stage, **labels)
+
+@contextlib.contextmanager
+def span(stage, **labels):
+    """
+    Time the block as `stage`, failures included, into STAGE_SECONDS and the current trace.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(stage, time.monotonic() - start, **labels)
+
+def propagate(func):
+    """
+    Wrap func to run in the caller's context, so spans recorded in pool threads land in the caller's trace.
+    """
+    context = contextvars.copy_context()
+    # a context can't be entered by two threads at once, every call runs in its own copy
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+def gauges(name, help, labels, values):
+    """
+    Gauge family from {label values tuple: value}.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for key, value in sorted(values.items()):
+        label_values = ','.join(f'{label}="{escape(str(v))}"' for label, v in zip(labels, key))
+        lines.append(f'{name}{{{label_values}}} {value}')
+    return '\n'.join(lines)
+
+def render(*extra):
+    return '\n'.join([STAGE_SECONDS.render(), REQUEST_SECONDS.render(), *extra]) + '\n'
@@ -0,0 +1,151 @@
+import os
+import time
+import random
+import hashlib
+import threading
+import contextlib
+from email.utils import parsedate_to_datetime
+
+RATE_LIMIT_RETRIES = int(os.getenv('RATE_LIMIT_RETRIES', 5))
+RATE_LIMIT_BACKOFF = float(os.getenv('RATE_LIMIT_BACKOFF', 2))
+RATE_LIMIT_MAX_BACKOFF = float(os.getenv('RATE_LIMIT_MAX_BACKOFF', 60))
+# requests per minute per API key, override with <PROVIDER>_RPM, 0 means no limit
+DEFAULT_RPM = {'gemini': 1000, 'jina': 200, 'firecrawl': 20, 'groq': 20}
+
+class RateLimited(Exception):
+    """
+    A 429 answered as a response rather than raised by the client library.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+def check_response(response):
+    if response.status_code == 429:
+        raise RateLimited(f"429 from {response.url}", parse_retry_after(response.headers.get('Retry-After')))
+    return response
+
+def throttled(e):
+    """
+    Whether e is a rate limit error, as (True, retry_after or None).
+    """
+    if isinstance(e, RateLimited):
+        return True, e.retry_after
+    # google.api_core's ResourceExhausted has code 429, groq and requests errors carry the response
+    response = getattr(e, 'response', None)
+    if getattr(e, 'code', None) == 429 or getattr(response, 'status_code', None) == 429:
+        headers = getattr(response, 'headers', None) or {}
+        return True, parse_retry_after(headers.get('retry-after'))
+    # firecrawl only puts the status in the message
+    return 'Status code 429' in str(e), None
+
+class Limiter:
+    """
+    Token bucket for one provider and API key. Callers reserve the next free token and sleep until it's due,
+    so they are served in arrival order; a 429 pauses the whole bucket.
+    """
+    def __init__(self, rpm, burst=None, concurrency=0):
+        self.rate = rpm / 60
+        self.capacity = burst or max(1, rpm // 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.stats = {'queue_depth': 0, 'requests': 0, 'waits': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                      'throttled': 0, 'retries': 0}
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            self.stats['requests'] += 1
+            self.stats['queue_depth'] += 1
+        if wait > 0:
+            time.sleep(wait)
+        with self.lock:
+            self.stats['queue_depth'] -= 1
+            if wait > 0:
+                self.stats['waits'] += 1
+                self.stats['wait_seconds'] += wait
+                self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+        return max(wait, 0)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.stats['throttled'] += 1
+
+    def slot(self):
+        return self.slots if self.slots else contextlib.nullcontext()
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def get_limiter(provider, key=None):
+    key_id = hashlib.sha256(key.encode()).hexdigest()[:8] if key else ''
+    with limiters_lock:
+        if (provider, key_id) not in limiters:
+            name = provider.upper()
+            rpm = int(os.getenv(f'{name}_RPM', DEFAULT_RPM.get(provider, 0)))
+            burst = int(os.getenv(f'{name}_BURST', 0))
+            concurrency = int(os.getenv(f'{name}_CONCURRENCY', 0))
+            limiters[(provider, key_id)] = Limiter(rpm, burst, concurrency)
+        return limiters[(provider, key_id)]
+
+def rate_limited_call(provider, func, *args, key=None, **kwargs):
+    """
+    Call func under the provider's limit for this API key, backing off and retrying on 429s: the server's
+    Retry-After when it sends one, exponential backoff with jitter otherwise.
+    """
+    limiter = get_limiter(provider, key)
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        limiter.acquire()
+        try:
+            with limiter.slot():
+                return func(*args, **kwargs)
+        except Exception as e:
+            is_throttled, retry_after = throttled(e)
+            if not is_throttled or attempt == RATE_LIMIT_RETRIES:
+                raise
+            delay = retry_after if retry_after is not None else min(RATE_LIMIT_BACKOFF * 2 ** attempt, RATE_LIMIT_MAX_BACKOFF)
+            delay *= random.uniform(1, 1.25)
+            print(f"{provider} rate limited, retrying in {delay:.1f}s ({attempt + 1}/{RATE_LIMIT_RETRIES})")
+            limiter.pause(delay)
+            with limiter.lock:
+                limiter.stats['retries'] += 1
+
+def rate_limit_stats():
+    """
+    Counters per provider, summed over API keys.
+    """
+    stats = {}
+    with limiters_lock:
+        items = list(limiters.items())
+    for (provider, _), limiter in items:
+        with limiter.lock:
+            provider_stats = stats.setdefault(provider, {'keys': 0})
+            provider_stats['keys'] += 1
+            for name, value in limiter.stats.items():
+                if name == 'max_wait_seconds':
+                    provider_stats[name] = max(provider_stats.get(name, 0), value)
+                else:
+                    provider_stats[name] = provider_stats.get(name, 0) + value
+    return stats
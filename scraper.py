@@ -7,11 +7,16 @@ import requests
 import os
 import re
 import pdb
+from http_client import http_session, api_session
+from rate_limit import rate_limited_call, check_response
+from cache import scrape_key, get_scrape_result, put_scrape_result, refresh_scrape_result, utcnow
 
 load_dotenv()
 FIRECRAWL_API_KEY=os.getenv('FIRECRAWL_API_KEY')
 JINA_API_KEY=os.getenv('JINA_API_KEY', None)
+JINA_API_URL = os.getenv('JINA_API_URL', 'https://r.jina.ai/')
 MARKER_API_URL = os.getenv('MARKER_API_URL')
+MARKER_API_TIMEOUT = int(os.getenv('MARKER_API_TIMEOUT', 600))
 DOWNLOADER_FOLDER = os.getenv('DOWNLOADER_FOLDER', './')
 
 def download_path(filename):
@@ -25,12 +30,50 @@ def write_flie(filename, content):
         f.write(content)
     print(f"File written to {filename}")
 
+def scrape_cached(url, scraper, options, fetch):
+    """
+    fetch(cached) returns (title, markdown, response_headers), or None when the cached copy is still valid (HTTP 304).
+    """
+    key = scrape_key(url, scraper, options)
+    cached = get_scrape_result(key)
+    if cached and cached.expires > utcnow():
+        print(f"Using cached {scraper} result for {url}")
+        return cached.title, cached.markdown
+
+    result = fetch(cached)
+    if result is None:
+        print(f"Revalidated cached {scraper} result for {url}")
+        refresh_scrape_result(key)
+        return cached.title, cached.markdown
+
+    title, markdown, headers = result
+    put_scrape_result(key, url, scraper, title, markdown, headers.get('ETag'), headers.get('Last-Modified'))
+    return title, markdown
+
+def conditional_get(url, cached):
+    headers = {}
+    if cached and cached.etag:
+        headers['If-None-Match'] = cached.etag
+    if cached and cached.last_modified:
+        headers['If-Modified-Since'] = cached.last_modified
+    response = http_session.get(url, headers=headers)
+    if cached and response.status_code == 304:
+        return None
+    # an error page must neither be converted nor cached
+    response.raise_for_status()
+    return response
+
 def firecrawl(url, **kwargs):
-    app = FirecrawlApp(api_key=FIRECRAWL_API_KEY)
     params = build_firecrawl_params(**kwargs)
-    response = app.scrape_url(url, params)
-    filename = download_path(response['metadata'].get('title', 'Untitled') + '.firecrawl.md')
-    write_flie(filename, response['markdown'])
+
+    def fetch(cached):
+        app = FirecrawlApp(api_key=FIRECRAWL_API_KEY)
+        response = rate_limited_call('firecrawl', app.scrape_url, url, params, key=FIRECRAWL_API_KEY)
+        return response['metadata'].get('title', 'Untitled'), response['markdown'], {}
+
+    title, markdown = scrape_cached(url, 'firecrawl', params, fetch)
+    filename = download_path(title + '.firecrawl.md')
+    write_flie(filename, markdown)
     return filename
 
 def build_firecrawl_params(**kwargs):
@@ -46,12 +89,19 @@ def build_firecrawl_params(**kwargs):
 def jina(url, **kwargs):
     headers = build_jina_params(**kwargs)
     data = {'url': url}
-    print(headers, data)
 
-    response = requests.post('https://r.jina.ai/', headers=headers, data=data)
-    json = response.json()
-    filename = download_path(json['data'].get('title', 'Untitled') + '.jina.md')
-    write_flie(filename, json['data']['content'])
+    def fetch(cached):
+        print(headers, data)
+        post = lambda: check_response(api_session.post(JINA_API_URL, headers=headers, data=data))
+        response = rate_limited_call('jina', post, key=headers.get('Authorization'))
+        response.raise_for_status()
+        json = response.json()
+        return json['data'].get('title', 'Untitled'), json['data']['content'], {}
+
+    options = {k: v for k, v in headers.items() if k != 'Authorization'}
+    title, markdown = scrape_cached(url, 'jina', options, fetch)
+    filename = download_path(title + '.jina.md')
+    write_flie(filename, markdown)
     return filename
 
 def build_jina_params(**kwargs):
@@ -75,21 +125,33 @@ def build_jina_params(**kwargs):
     return headers
 
 def magic_markdownify(url):
-    response = requests.get(url)
-    extractor = GeneralExtractor()
-    data = extractor.extract(response.text, base_url=url)
-    content = markdownify(data['html']).strip()
-    markdown = '# {title}\n\n{content}'.format(title=data['title'], content=content)
-    filename = download_path(data.get('title', 'Untitled') + '.magic.md')
+    def fetch(cached):
+        response = conditional_get(url, cached)
+        if response is None:
+            return None
+        extractor = GeneralExtractor()
+        data = extractor.extract(response.text, base_url=url)
+        content = markdownify(data['html']).strip()
+        markdown = '# {title}\n\n{content}'.format(title=data['title'], content=content)
+        return data.get('title', 'Untitled'), markdown, response.headers
+
+    title, markdown = scrape_cached(url, 'magic_markdownify', {}, fetch)
+    filename = download_path(title + '.magic.md')
     write_flie(filename, markdown)
     return filename
     
 def readability_markdownify(url):
-    response = requests.get(url)
-    doc = Document(response.text)
-    filename = download_path(doc.title() + '.readability.md')
-    content = markdownify(doc.summary())
-    markdown = '# {title}\n\n{content}'.format(title=doc.title(), content=content)
+    def fetch(cached):
+        response = conditional_get(url, cached)
+        if response is None:
+            return None
+        doc = Document(response.text)
+        content = markdownify(doc.summary())
+        markdown = '# {title}\n\n{content}'.format(title=doc.title(), content=content)
+        return doc.title(), markdown, response.headers
+
+    title, markdown = scrape_cached(url, 'readability_markdownify', {}, fetch)
+    filename = download_path(title + '.readability.md')
     write_flie(filename, markdown)
     return filename
 
@@ -103,22 +165,20 @@ def download_file(url):
 
     try:
         print(f"Downloading {url} to {filename}")
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        total_size = int(response.headers.get('content-length', 0))
+        headers = {'Range': f'bytes={local_file_size}-'} if local_file_size else {}
+        response = http_session.get(url, headers=headers, stream=True)
 
-        if local_file_size == total_size:
+        if response.status_code == 416:
+            response.close()
             print(f"File already downloaded completely: {filename}")
             return filename
-
-        headers = {'Range': f'bytes={local_file_size}-'}
-        response = requests.get(url, headers=headers, stream=True)
         response.raise_for_status()
 
-        with open(filename, 'ab') as file:
+        # 服务器忽略Range时会返回完整内容，需要覆盖而不是追加
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        with open(filename, mode) as file:
             # 将响应逐块写入文件以防止内存溢出
-            for chunk in response.iter_content(chunk_size=1024):
+            for chunk in response.iter_content(chunk_size=64 * 1024):
                 file.write(chunk)
 
         print('File downloaded: ', filename)
@@ -145,8 +205,9 @@ def pdf2markdown(pdf_file):
     marker-api
     """
     print('Convert pdf to markdown using marker-api: ', pdf_file)
-    files = {'pdf_file': (pdf_file, open(pdf_file, 'rb'), 'application/pdf')}
-    response = requests.post(MARKER_API_URL, files=files)
+    with open(pdf_file, 'rb') as f:
+        files = {'pdf_file': (pdf_file, f, 'application/pdf')}
+        response = http_session.post(MARKER_API_URL, files=files, timeout=MARKER_API_TIMEOUT)
     if response.status_code != 200:
         print(response.text)
         raise Exception('Failed to convert pdf or retrieve the results')
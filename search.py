@@ -0,0 +1,98 @@
+import json
+import base64
+import hashlib
+from pathlib import Path
+from sqlalchemy import text
+
+# trigram keeps the substring semantics of the old LIKE filter, CJK text included
+FTS_SCHEMA = "CREATE VIRTUAL TABLE conversations_fts USING fts5(id UNINDEXED, urls, files, titles, content, tokenize='trigram')"
+# bm25 weights for id, urls, files, titles, content
+FTS_RANK = "bm25(conversations_fts, 0.0, 2.0, 2.0, 3.0, 1.0)"
+MIN_TOKEN_LENGTH = 3
+
+def fts_rowid(id, seq=None):
+    # stable rowids so that reindexing and deleting are rowid lookups: one row for the conversation itself
+    # (urls, files, titles) and one per message (content)
+    key = id if seq is None else f"{id}/{seq}"
+    return int(hashlib.sha256(key.encode()).hexdigest()[:15], 16)
+
+def create_fts(connection):
+    """
+    Create the index on first use and backfill it from the existing conversations.
+    """
+    if connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'conversations_fts'")).first():
+        return
+    connection.execute(text(FTS_SCHEMA))
+    rows = connection.execute(text("SELECT id, uri2path, files, urls FROM conversations")).all()
+    for row in rows:
+        index_conversation(connection, row.id, *[json.loads(v) if v else [] for v in row[1:]])
+        messages = connection.execute(text("SELECT seq, role, parts FROM messages WHERE conversation_id = :id"), {'id': row.id})
+        index_messages(connection, row.id, [(message.seq, {'role': message.role, 'parts': json.loads(message.parts)}) for message in messages])
+    print(f"Indexed {len(rows)} conversations for search")
+
+def message_text(entry):
+    # uploaded files and inline sources are found by their titles, not their content
+    return "\n".join(part if isinstance(part, str) else part.get('text', '') for part in entry['parts']
+                     if isinstance(part, str) or not ('file_data' in part or 'source' in part))
+
+def index_conversation(connection, id, uri2path, files, urls):
+    titles = [Path(path).stem for path in (uri2path or {}).values()]
+    unindex_conversation(connection, id)
+    connection.execute(text("INSERT INTO conversations_fts (rowid, id, urls, files, titles, content) "
+                            "VALUES (:rowid, :id, :urls, :files, :titles, '')"),
+                       {'rowid': fts_rowid(id), 'id': id, 'urls': "\n".join(urls), 'files': "\n".join(files), 'titles': "\n".join(titles)})
+
+def unindex_conversation(connection, id):
+    connection.execute(text("DELETE FROM conversations_fts WHERE rowid = :rowid"), {'rowid': fts_rowid(id)})
+
+def index_messages(connection, id, turns):
+    """
+    Index (seq, entry) pairs of a conversation's history.
+    """
+    rows = [{'rowid': fts_rowid(id, seq), 'id': id, 'content': message_text(entry)} for seq, entry in turns]
+    if rows:
+        connection.execute(text("INSERT OR REPLACE INTO conversations_fts (rowid, id, content) VALUES (:rowid, :id, :content)"), rows)
+
+def unindex_messages(connection, id, turns):
+    """
+    Drop the first `turns` messages of a conversation from the index.
+    """
+    rows = [{'rowid': fts_rowid(id, seq)} for seq in range(turns)]
+    if rows:
+        connection.execute(text("DELETE FROM conversations_fts WHERE rowid = :rowid"), rows)
+
+def is_searchable(filtering):
+    tokens = filtering.split()
+    return bool(tokens) and all(len(token) >= MIN_TOKEN_LENGTH for token in tokens)
+
+def match_expression(token):
+    return '"' + token.replace('"', '""') + '"'
+
+def search(connection, filtering, limit, offset=0, cursor=None):
+    """
+    Conversation ids matching every token, best match first. Returns (ids, next_cursor).
+
+    Tokens may match different rows of a conversation (its title and a message), so each token is matched
+    on its own and a conversation's rank sums its best row per token.
+    """
+    rank, id = decode_cursor(cursor) if cursor else (None, None)
+    tokens = filtering.split()
+    matches = " UNION ALL ".join(
+        f"SELECT id, {i} AS token, {FTS_RANK} AS rank FROM conversations_fts WHERE conversations_fts MATCH :match{i}"
+        for i in range(len(tokens)))
+    params = {f'match{i}': match_expression(token) for i, token in enumerate(tokens)}
+    # materialized so bm25 is evaluated before SQLite flattens the matches into the aggregates
+    rows = connection.execute(text(
+        f"WITH hits AS MATERIALIZED ({matches}) "
+        "SELECT id, sum(rank) AS rank FROM (SELECT id, token, min(rank) AS rank FROM hits GROUP BY id, token) "
+        "GROUP BY id HAVING count(*) = :tokens AND (:rank IS NULL OR sum(rank) > :rank OR (sum(rank) = :rank AND id > :id)) "
+        "ORDER BY rank, id LIMIT :limit OFFSET :offset"),
+        dict(params, tokens=len(tokens), rank=rank, id=id, limit=limit, offset=0 if cursor else offset)).all()
+    next_cursor = encode_cursor(rows[-1].rank, rows[-1].id) if len(rows) == limit else None
+    return [row.id for row in rows], next_cursor
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
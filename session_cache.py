@@ -0,0 +1,169 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv('SESSION_CACHE_MAX_ENTRIES', 256))
+SESSION_CACHE_MAX_ENTRIES_PER_USER = int(os.getenv('SESSION_CACHE_MAX_ENTRIES_PER_USER', 64))
+SESSION_CACHE_MAX_BYTES = int(os.getenv('SESSION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+SESSION_CACHE_MAX_BYTES_PER_USER = int(os.getenv('SESSION_CACHE_MAX_BYTES_PER_USER', 64 * 1024 * 1024))
+SESSION_CACHE_IDLE_TTL = int(os.getenv('SESSION_CACHE_IDLE_TTL', 3600))
+
+def summarizer_size(summarizer):
+    """
+    Rough in-memory footprint of a conversation: the text it holds in its chat history.
+    """
+    if not summarizer.chat:
+        return 0
+    try:
+        history = summarizer.chat.history
+    except Exception:
+        # a response is still streaming, keep the previous estimate
+        return None
+    return sum(len(part.text) for entry in history for part in entry.parts if 'text' in part)
+
+class CacheEntry:
+    def __init__(self, summarizer):
+        self.summarizer = summarizer
+        self.size = summarizer_size(summarizer) or 0
+        self.last_access = time.monotonic()
+        # requests using the summarizer, it isn't evicted under them
+        self.leases = 0
+
+class SessionCache:
+    """
+    LRU cache of active conversations keyed by (db, conversation_id), bounded per user and globally by
+    entry count and history size, with an idle TTL. Evicted conversations are saved before being dropped, those
+    leased by a request or failing to save are kept.
+    """
+    def __init__(self, max_entries=SESSION_CACHE_MAX_ENTRIES, max_entries_per_user=SESSION_CACHE_MAX_ENTRIES_PER_USER,
+                 max_bytes=SESSION_CACHE_MAX_BYTES, max_bytes_per_user=SESSION_CACHE_MAX_BYTES_PER_USER,
+                 idle_ttl=SESSION_CACHE_IDLE_TTL):
+        self.max_entries = max_entries
+        self.max_entries_per_user = max_entries_per_user
+        self.max_bytes = max_bytes
+        self.max_bytes_per_user = max_bytes_per_user
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, db, conversation_id, lease=False):
+        """
+        With lease=True the conversation isn't evicted until release() is called.
+        """
+        with self.lock:
+            entry = self.entries.get((db, conversation_id))
+            if entry:
+                self.stats['hits'] += 1
+                self.touch((db, conversation_id), entry)
+                entry.leases += lease
+            else:
+                self.stats['misses'] += 1
+            evicted = self.shrink()
+        self.evict(evicted)
+        return entry.summarizer if entry else None
+
+    def put(self, db, conversation_id, summarizer, lease=False):
+        with self.lock:
+            key = (db, conversation_id)
+            self.entries[key] = CacheEntry(summarizer)
+            self.entries[key].leases += lease
+            self.entries.move_to_end(key)
+            evicted = self.shrink(keep=key)
+        self.evict(evicted)
+
+    def release(self, db, conversation_id, summarizer):
+        with self.lock:
+            entry = self.entries.get((db, conversation_id))
+            # the entry may have been replaced or popped since
+            if entry and entry.summarizer is summarizer and entry.leases:
+                entry.leases -= 1
+
+    def pop(self, db, conversation_id):
+        with self.lock:
+            entry = self.entries.pop((db, conversation_id), None)
+        return entry.summarizer if entry else None
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def values(self, db):
+        with self.lock:
+            return [entry.summarizer for (entry_db, _), entry in self.entries.items() if entry_db == db]
+
+    def touch(self, key, entry):
+        size = summarizer_size(entry.summarizer)
+        if size is not None:
+            entry.size = size
+        entry.last_access = time.monotonic()
+        self.entries.move_to_end(key)
+
+    def usage(self, db=None):
+        entries = [entry for (entry_db, _), entry in self.entries.items() if db is None or entry_db == db]
+        return len(entries), sum(entry.size for entry in entries)
+
+    def shrink(self, keep=None):
+        evicted = []
+        now = time.monotonic()
+
+        def evict(key):
+            evicted.append((key, self.entries.pop(key)))
+            self.stats['evictions'] += 1
+
+        def evictable(key):
+            return key != keep and not self.entries[key].leases
+
+        for key, entry in list(self.entries.items()):
+            if evictable(key) and now - entry.last_access > self.idle_ttl:
+                evict(key)
+
+        for db in {entry_db for entry_db, _ in self.entries}:
+            count, size = self.usage(db)
+            for key in [key for key in self.entries if key[0] == db and evictable(key)]:
+                if count <= self.max_entries_per_user and size <= self.max_bytes_per_user:
+                    break
+                count, size = count - 1, size - self.entries[key].size
+                evict(key)
+
+        count, size = self.usage()
+        for key in [key for key in self.entries if evictable(key)]:
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            count, size = count - 1, size - self.entries[key].size
+            evict(key)
+        return evicted
+
+    def save(self, summarizers):
+        """
+        Save the summarizers, returning those that failed.
+        """
+        failed = []
+        for summarizer in summarizers:
+            try:
+                summarizer.save()
+            except Exception as e:
+                print(f"Failed to save conversation {summarizer.id}: {e}")
+                failed.append(summarizer)
+        return failed
+
+    def evict(self, evicted):
+        failed = self.save([entry.summarizer for _, entry in evicted])
+        with self.lock:
+            for key, entry in evicted:
+                # kept as the least recently used, its unsaved turns would be lost otherwise
+                if entry.summarizer in failed and key not in self.entries:
+                    self.entries[key] = entry
+                    self.entries.move_to_end(key, last=False)
+
+    def save_all(self):
+        with self.lock:
+            summarizers = [entry.summarizer for entry in self.entries.values()]
+        self.save(summarizers)
+
+    @property
+    def dict(self):
+        with self.lock:
+            count, size = self.usage()
+            return dict(self.stats, entries=count, bytes=size)
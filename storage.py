@@ -0,0 +1,46 @@
+import os
+import threading
+from sqlalchemy import create_engine, event
+
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 30000))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run alongside the writer, busy_timeout makes writers wait for each other instead of failing
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+def build_engine(url):
+    engine = create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+class EngineRegistry:
+    """
+    Engines opened lazily on first use, running `setup` (schema creation, migrations) once per engine.
+    """
+    def __init__(self, url, setup=None):
+        self.url = url
+        self.setup = setup
+        self.engines = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        engine = self.engines.get(name)
+        if engine:
+            return engine
+        with self.lock:
+            if name not in self.engines:
+                engine = build_engine(self.url.format(name=name))
+                if self.setup:
+                    self.setup(engine)
+                self.engines[name] = engine
+            return self.engines[name]
+
+    def __contains__(self, name):
+        return name in self.engines
@@ -2,29 +2,17 @@ import yt_dlp
 import os
 import argparse
 import pdb
-import re
-import requests
 import functools
 from dotenv import load_dotenv
-from groq import Groq
+from yt_dlp.extractor import gen_extractor_classes
 from scraper import download_path
+from subtitles import convert_subtitles
+from cache import find_video, put_video_info, get_transcript, put_transcript
+from transcriber import transcribe as transcribe_audio
+from metrics import span
 
 load_dotenv()
-GROQ_API_KEY=os.getenv('GROQ_API_KEY')
-WHISPER_ASR_API_URL = os.getenv('WHISPER_ASR_API_URL')
-
-def undo_proxy(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        http_proxy = os.environ.pop('http_proxy', None)
-        https_proxy = os.environ.pop('https_proxy', None)
-
-        result = func(*args, **kwargs)
-
-        os.environ['http_proxy'] = http_proxy
-        os.environ['https_proxy'] = https_proxy
-        return result
-    return wrapper
+YTDLP_PROXY = os.getenv('YTDLP_PROXY')
 
 def get_best_subtitle_language(subtitles):
     preferred_languages = ['en', 'zh', 'zh-Hans', 'zh-Hant', 'zh-TW', 'en-US', 'en-GB']  # 添加更多语言代码
@@ -37,95 +25,131 @@ def get_best_subtitle_language(subtitles):
     # 如果没有首选语言，返回第一个可用的语言
     return next(iter(subtitles)) if subtitles else None
 
-def srt_to_txt(srt_file_path, txt_file_path):
+def srt_to_txt(srt_file_path, txt_file_path, timestamp_interval=None, rolling=False):
     """
-    将SRT格式的字幕文件转换为纯文本TXT文件。
+    将SRT/VTT格式的字幕文件转换为纯文本TXT文件。
     
-    :param srt_file_path: SRT文件的路径
+    :param srt_file_path: SRT/VTT文件的路径
     :param txt_file_path: 输出TXT文件的路径
+    :param timestamp_interval: 每隔多少秒插入一个时间戳，默认不插入
+    :param rolling: 自动字幕，合并滚动重复的行
     """
-    # 用于匹配SRT文件中的时间戳行的正则表达式
-    timestamp_pattern = re.compile(r'\d+:\d+:\d+,\d+ --> \d+:\d+:\d+,\d+')
-
-    with open(srt_file_path, 'r', encoding='utf-8') as srt_file, \
-         open(txt_file_path, 'w', encoding='utf-8') as txt_file:
-        
-        skip_next = False
-        for line in srt_file:
-            line = line.strip()
-            
-            # 跳过空行和序号行
-            if not line or line.isdigit():
-                continue
-            
-            # 跳过时间戳行
-            if timestamp_pattern.match(line) or skip_next:
-                skip_next = False
-                continue
-            
-            # 写入字幕文本
-            txt_file.write(line + ' ')
-            
-            # 如果这行以 '>' 结尾，下一行可能是时间戳的一部分，需要跳过
-            if line.endswith('>'):
-                skip_next = True
-
+    convert_subtitles(srt_file_path, txt_file_path, timestamp_interval, rolling)
     print(f"转换完成。文本已保存到 {txt_file_path}")
 
-def download_captions(url, cookies_file=None, language=None, convert_to_txt=False, transcribe=True):
-    ydl_opts = {
-        'skip_download': True,
-        'postprocessors': [{
+def ydl_options(cookies_file=None, convert_subtitles=True):
+    ydl_opts = {'skip_download': True}
+    if convert_subtitles:
+        ydl_opts['postprocessors'] = [{
             'format': 'srt',
             'key': 'FFmpegSubtitlesConvertor',
             'when': 'before_dl'
         }]
-    }
-    
+    else:
+        # 直接解析下载的VTT/SRT，不再经过ffmpeg转换
+        ydl_opts['subtitlesformat'] = 'vtt/srt/best'
+
     if cookies_file:
         ydl_opts['cookiefile'] = cookies_file
+    if YTDLP_PROXY:
+        ydl_opts['proxy'] = YTDLP_PROXY
+    return ydl_opts
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        safe_title = download_path("".join([c for c in info['title'] if c.isalpha() or c.isdigit() or c==' ']).rstrip())
+@functools.lru_cache(maxsize=1024)
+def video_key(url):
+    """
+    (extractor, video id) parsed from the url without any network request, None if it can't be.
+    """
+    for ie in gen_extractor_classes():
+        if ie.ie_key() != 'Generic' and ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return (ie.ie_key(), video_id) if video_id else None
+    return None
+
+def caption_format(convert_to_txt=False, timestamp_interval=None):
+    # download_youtube_captions 实际产出的格式
+    return 'srt' if not convert_to_txt else f'txt-{timestamp_interval}s' if timestamp_interval else 'txt'
+
+def download_captions(url, cookies_file=None, language=None, convert_to_txt=False, transcribe=True, timestamp_interval=None):
+    # 缓存按 (extractor, 视频ID, 语言, 格式) 查找，命中时不访问网络也不重新识别。
+    # 格式是实际产出的文件：字幕按转换方式区分；没有字幕时是音频或识别结果，与转换参数无关
+    output_format = caption_format(convert_to_txt, timestamp_interval)
+    key = video_key(url) or find_video(url)
+    if key:
+        for format in (output_format, 'asr' if transcribe else 'audio'):
+            cached = get_transcript(*key, language, format)
+            if cached:
+                print(f"使用缓存字幕: {cached}")
+                return cached
+
+    with yt_dlp.YoutubeDL(ydl_options(cookies_file, convert_subtitles=not convert_to_txt)) as ydl:
+        with span('ytdlp_extract', scraper='yt-dlp'):
+            info = ydl.extract_info(url, download=False)
+        key = key or (info['extractor_key'], info['id'])
+        put_video_info(*key, url, info)
+        # 文件名带上视频ID，同名视频不会互相覆盖
+        safe_title = "".join([c for c in info['title'] if c.isalpha() or c.isdigit() or c==' ']).rstrip()
+        safe_title = download_path(f"{safe_title} [{info['id']}]")
         ydl.params['outtmpl']['default'] = f'{safe_title}.%(ext)s'
+        requested_language = language
         if info.get('subtitles') and 'live_chat' not in info.get('subtitles'):
             if not language:
                 language = get_best_subtitle_language(info['subtitles'])
-            caption_file = download_youtube_captions(url, ydl, safe_title, language, automatic_captions=False, convert_to_txt=convert_to_txt)
+            caption_file = download_youtube_captions(info, ydl, safe_title, language, automatic_captions=False, convert_to_txt=convert_to_txt, timestamp_interval=timestamp_interval)
+            source = 'subtitles'
         elif info.get('automatic_captions'):
             if not language:
                 language = get_best_subtitle_language(info['automatic_captions'])
-            caption_file = download_youtube_captions(url, ydl, safe_title, language, automatic_captions=True, convert_to_txt=convert_to_txt)
+            caption_file = download_youtube_captions(info, ydl, safe_title, language, automatic_captions=True, convert_to_txt=convert_to_txt, timestamp_interval=timestamp_interval)
+            source = 'automatic_captions'
         else:
-            audio_file = download_youtube_audio(url, ydl, safe_title)
-            if not transcribe:
-                return audio_file
-            elif info.get('duration', 0) <= 7200 and is_file_size_within_limit(audio_file, 25 * 1024 * 1024):
-                caption_file = groq_transcribe(audio_file, language)
-            else:
-                caption_file = whisper_asr_transcribe(audio_file, language=language)
+            caption_file = download_youtube_audio(url, info, ydl, safe_title)
+            source = 'audio'
+            if transcribe:
+                with span('transcribe', scraper='yt-dlp'):
+                    caption_file = transcribe_audio(caption_file, language)
+                source = 'asr'
+            output_format = source
+    put_transcript(*key, requested_language, output_format, caption_file, source)
     return caption_file
 
-def is_file_size_within_limit(filename, max_size):
-    return os.path.getsize(filename) < max_size
-
-def download_youtube_captions(url, ydl, safe_title, language, automatic_captions=False, convert_to_txt=False):
+def download_playlist_captions(url, cookies_file=None, language=None, convert_to_txt=False, transcribe=True, timestamp_interval=None):
+    """
+    下载播放列表中每个视频的字幕，已缓存的视频直接复用。
+    """
+    ydl_opts = dict(ydl_options(cookies_file), extract_flat='in_playlist')
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        playlist = ydl.extract_info(url, download=False)
+    caption_files = []
+    for entry in playlist.get('entries') or []:
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        try:
+            caption_files.append(download_captions(entry_url, cookies_file, language, convert_to_txt, transcribe, timestamp_interval))
+        except Exception as e:
+            print(f"下载失败 {entry_url}: {e}")
+    return caption_files
+
+def download_youtube_captions(info, ydl, safe_title, language, automatic_captions=False, convert_to_txt=False, timestamp_interval=None):
     if automatic_captions:
         ydl.params['writeautomaticsub'] = True
     else:
         ydl.params['writesubtitles'] = True
 
     ydl.params['subtitleslangs'] = [language]
-    ydl.download([url])
-    print(f"已下载字幕: {safe_title}.{language}.srt")
+    # reuse the extracted info instead of letting ydl.download() extract the video again
+    with span('ytdlp_download', scraper='yt-dlp'):
+        result = ydl.process_ie_result(info, download=True)
     if convert_to_txt:
-        srt_to_txt(f'{safe_title}.{language}.srt', f'{safe_title}.{language}.txt')
+        subtitle = result['requested_subtitles'][language]
+        subtitle_file = subtitle.get('filepath') or f"{safe_title}.{language}.{subtitle['ext']}"
+        print(f"已下载字幕: {subtitle_file}")
+        srt_to_txt(subtitle_file, f'{safe_title}.{language}.txt', timestamp_interval, rolling=automatic_captions)
         return f'{safe_title}.{language}.txt'
     else:
+        print(f"已下载字幕: {safe_title}.{language}.srt")
         return f'{safe_title}.{language}.srt'
 
-def download_youtube_audio(url, ydl, safe_title):
+def download_youtube_audio(url, info, ydl, safe_title):
     if 'youtube.com' in url or 'youtu.be' in url:
         ydl.format_selector = ydl.build_format_selector('139')
         ext = 'm4a'
@@ -136,55 +160,25 @@ def download_youtube_audio(url, ydl, safe_title):
         ydl.format_selector = ydl.build_format_selector('30216')
         ext = 'm4a'
     ydl.params['skip_download'] = False
-    ydl.download([url])
+    with span('ytdlp_download', scraper='yt-dlp'):
+        ydl.process_ie_result(info, download=True)
     audio_file = f"{safe_title}.{ext}"
     return audio_file
 
-def groq_transcribe(audio_file, language):
-    client = Groq(api_key=GROQ_API_KEY)
-    print(f"使用Groq进行语音识别: {audio_file}")
-    with open(audio_file, "rb") as file:
-        transcription = client.audio.transcriptions.create(
-            file=(audio_file, file.read()),
-            model="whisper-large-v3",
-            response_format="verbose_json",
-            language=language,
-            temperature=0.0
-        )
-    
-    safe_title = os.path.splitext(audio_file)[0]
-    txt_file = f"{safe_title}.txt"
-    text = "\n".join([segment['text'] for segment in transcription.segments])
-    with open(txt_file, "w", encoding="utf-8") as f:
-        f.write(text)
-    print(f"已识别字幕: {safe_title}.txt")
-    return txt_file
-
-@undo_proxy
-def whisper_asr_transcribe(audio_file, **kwargs):
-    files = {'audio_file': (audio_file, open(audio_file, "rb"), 'audio/x-m4a')}
-    valid_params = ['encode', 'task', 'vad_filter', 'language', 'word_timestamps', 'output', 'initial_prompt']
-    params = {k: str(v).lower() for k, v in kwargs.items() if v is not None and k in valid_params}
-    headers = {'accept': 'application/json'}
-    print(f"使用Whisper ASR进行语音识别: {audio_file}")
-    response = requests.post(WHISPER_ASR_API_URL, files=files, params=params, headers=headers)
-    response.raise_for_status()
-    safe_title = os.path.splitext(audio_file)[0]
-    output_format = kwargs.get('output', 'txt')
-    out_file = f"{safe_title}.{output_format}"
-    with open(out_file, "w", encoding="utf-8") as f:
-        f.write(response.text)
-    print(f"已识别字幕: {safe_title}.{output_format}")
-    return out_file
-
 def main():
     parser = argparse.ArgumentParser(description="下载YouTube视频的字幕或音频")
     parser.add_argument("url", help="YouTube视频的URL")
     parser.add_argument("--cookies", help="cookies文件的路径")
     parser.add_argument("--language", help="指定字幕语言（例如：en, es, fr）")
+    parser.add_argument("--playlist", help="下载播放列表中所有视频的字幕", action='store_true', default=False)
+    parser.add_argument("--txt", help="把字幕转换为纯文本", action='store_true', default=False)
+    parser.add_argument("--timestamp_interval", type=int, help="纯文本中每隔多少秒插入一个时间戳")
     args = parser.parse_args()
 
-    download_captions(args.url, args.cookies, args.language)
+    if args.playlist:
+        download_playlist_captions(args.url, args.cookies, args.language, convert_to_txt=args.txt, timestamp_interval=args.timestamp_interval)
+    else:
+        download_captions(args.url, args.cookies, args.language, convert_to_txt=args.txt, timestamp_interval=args.timestamp_interval)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import re
+import html
+
+# a cue ends at the first blank line; whitespace-only ones (YouTube VTT) are emptied first
+BLANK = re.compile(r'\n[ \t]+(?=\n)')
+# VTT inline timings (<00:00:01.000>) and the VTT/SRT styling tags (<c.color>, <i>, <v Speaker>, <font ...>), a
+# '<' in the text itself is left alone
+TAG = re.compile(r'<\d\d:[\d:.]*>|</?(?:[cibuv]|lang|ruby|rt|font)(?:[ .\t][^>\n]*)?>')
+
+def parse_timestamp(timestamp):
+    # [hh:]mm:ss,mmm or [hh:]mm:ss.mmm
+    *hours, minutes, seconds = timestamp.split(':')
+    return int(hours[0] if hours else 0) * 3600 + int(minutes) * 60 + float(seconds.replace(',', '.'))
+
+def parse_cues(data):
+    """
+    Yield (start, lines) for every cue of an SRT or VTT document, str or bytes. start is the timestamp as
+    written, parse_timestamp() turns it into seconds; lines keep their surrounding whitespace.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig', errors='replace')
+    if '\r' in data:
+        data = data.replace('\r\n', '\n').replace('\r', '\n')
+    # tags and entities are dealt with once for the whole document, not per cue
+    if '<' in data:
+        data = TAG.sub('', data)
+    if '&' in data:
+        data = html.unescape(data)
+    if '\n ' in data or '\n\t' in data:
+        data = BLANK.sub('\n', data)
+    # one pass of str.split over the whole document; a cue is the block holding a timing line, SRT
+    # (00:00:01,000 --> ...) and VTT (00:01.000 --> ...) alike, after its number or identifier if any
+    for block in data.split('\n\n'):
+        head, arrow, rest = block.partition('-->')
+        if arrow:
+            yield head.rsplit('\n', 1)[-1].strip(), rest.rstrip().split('\n')[1:]
+
+def collapse_rolling(cues):
+    """
+    Drop the line YouTube auto-captions roll over from one cue to the next: the previous cue's last line
+    repeated as this cue's first one.
+    """
+    last = None
+    for start, lines in cues:
+        if lines and lines[0].strip() == last:
+            lines = lines[1:]
+        if lines:
+            last = lines[-1].strip()
+        yield start, lines
+
+def format_marker(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"[{hours}:{minutes:02d}:{seconds:02d}]" if hours else f"[{minutes:02d}:{seconds:02d}]"
+
+def subtitles_to_text(data, timestamp_interval=None, rolling=False):
+    """
+    Compact plain text of a subtitle file. With timestamp_interval (seconds), start a new paragraph with a
+    [mm:ss] marker at most once per interval. rolling=True is for auto-captions, see collapse_rolling().
+    """
+    cues = parse_cues(data)
+    if rolling:
+        cues = collapse_rolling(cues)
+    if not timestamp_interval:
+        return ' '.join(' '.join(' '.join(lines) for _, lines in cues).split())
+    paragraphs = []
+    next_marker = 0
+    for start, lines in cues:
+        if not lines:
+            continue
+        start = parse_timestamp(start)
+        if start >= next_marker:
+            paragraphs.append([format_marker(start)])
+            next_marker = (start // timestamp_interval + 1) * timestamp_interval
+        paragraphs[-1].extend(lines)
+    return '\n'.join(' '.join(' '.join(paragraph).split()) for paragraph in paragraphs)
+
+def convert_subtitles(subtitle_file, txt_file, timestamp_interval=None, rolling=False):
+    with open(subtitle_file, 'rb') as f:
+        text = subtitles_to_text(f.read(), timestamp_interval, rolling)
+    with open(txt_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return txt_file
@@ -0,0 +1,42 @@
+"""
+Streaming against benchmarks/fake_services.py, nothing leaves the machine.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from fake_services import FakeServices
+
+@pytest.fixture(scope='module')
+def services(tmp_path_factory):
+    services = FakeServices(latency={'generate': 0, 'stream_chunk': 0, 'jina': 0, 'count_tokens': 0}).start()
+    workdir = tmp_path_factory.mktemp('summarizer')
+    os.makedirs(workdir / 'db')
+    os.environ.update({'GEMINI_API_KEY': 'test', 'GEMINI_API_BASE': services.url, 'JINA_API_URL': f'{services.url}/jina/',
+                       'JINA_API_KEY': '', 'DOWNLOADER_FOLDER': f'{workdir}/', 'GEMINI_RPM': '0', 'JINA_RPM': '0'})
+    # the repo modules open db/ and read their settings at import
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    import gemini_client
+    gemini_client.configure()
+    yield services
+    os.chdir(cwd)
+    services.stop()
+
+def test_closed_stream_leaves_the_chat_usable(services):
+    from Summarize import GeminiSummarizer
+    summarizer = GeminiSummarizer(urls=[f'{services.url}/files/page.html'], overwrite=True)
+    stream = summarizer.send_stream('summarize')
+    next(stream)
+    assert len(summarizer.json) == 1
+    stream.close()
+
+    assert len(summarizer.json) == 1
+    summarizer.send('and then?')
+    assert [entry['role'] for entry in summarizer.json] == ['user', 'user', 'model']
+    summarizer.save()
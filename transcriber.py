@@ -0,0 +1,219 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from groq import Groq
+from http_client import direct_session
+from rate_limit import rate_limited_call
+
+load_dotenv()
+GROQ_API_KEY = os.getenv('GROQ_API_KEY')
+GROQ_WORKERS = int(os.getenv('GROQ_WORKERS', 4))
+GROQ_MAX_FILE_SIZE = 25 * 1024 * 1024
+WHISPER_ASR_API_URL = os.getenv('WHISPER_ASR_API_URL')
+WHISPER_ASR_TIMEOUT = int(os.getenv('WHISPER_ASR_TIMEOUT', 3600))
+WHISPER_ASR_WORKERS = int(os.getenv('WHISPER_ASR_WORKERS', 2))
+FFMPEG = os.getenv('FFMPEG', 'ffmpeg')
+FFPROBE = os.getenv('FFPROBE', 'ffprobe')
+TRANSCRIBE_CHUNK_SECONDS = int(os.getenv('TRANSCRIBE_CHUNK_SECONDS', 600))
+TRANSCRIBE_CHUNK_OVERLAP = int(os.getenv('TRANSCRIBE_CHUNK_OVERLAP', 5))
+# how far a cut may move from the nominal chunk boundary to land in a silence
+TRANSCRIBE_SILENCE_WINDOW = int(os.getenv('TRANSCRIBE_SILENCE_WINDOW', 60))
+
+class Chunk:
+    def __init__(self, index, start, end, cut_start, cut_end):
+        self.index = index
+        # audio actually sent, overlapping the neighbours by TRANSCRIBE_CHUNK_OVERLAP
+        self.start = start
+        self.end = end
+        # the part of the timeline this chunk owns once the overlaps are resolved
+        self.cut_start = cut_start
+        self.cut_end = cut_end
+        self.path = None
+
+class Backend:
+    def __init__(self, name, transcribe, workers, max_size=None):
+        self.name = name
+        self.transcribe = transcribe
+        self.workers = workers
+        self.max_size = max_size
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def accepts(self, path):
+        return not self.max_size or os.path.getsize(path) < self.max_size
+
+def groq_segments(audio_file, language=None):
+    # retries are left to the rate limiter, which also spaces out the other chunks
+    client = Groq(api_key=GROQ_API_KEY, max_retries=0)
+
+    def transcribe():
+        with open(audio_file, "rb") as f:
+            return client.audio.transcriptions.create(
+                file=(os.path.basename(audio_file), f),
+                model="whisper-large-v3",
+                response_format="verbose_json",
+                language=language,
+                temperature=0.0
+            )
+    transcription = rate_limited_call('groq', transcribe, key=GROQ_API_KEY)
+    return [(segment['start'], segment['end'], segment['text']) for segment in transcription.segments]
+
+def whisper_asr_segments(audio_file, language=None):
+    params = {'output': 'json', 'encode': 'true'}
+    if language:
+        params['language'] = language
+    with open(audio_file, "rb") as f:
+        files = {'audio_file': (os.path.basename(audio_file), f, 'audio/mpeg')}
+        response = direct_session.post(WHISPER_ASR_API_URL, files=files, params=params,
+                                       headers={'accept': 'application/json'}, timeout=WHISPER_ASR_TIMEOUT)
+    response.raise_for_status()
+    return [(segment['start'], segment['end'], segment['text']) for segment in response.json()['segments']]
+
+# built once so the worker limits hold across every transcription in the process, not per video
+BACKENDS = []
+if GROQ_API_KEY:
+    BACKENDS.append(Backend('groq', groq_segments, GROQ_WORKERS, max_size=GROQ_MAX_FILE_SIZE))
+if WHISPER_ASR_API_URL:
+    BACKENDS.append(Backend('whisper_asr', whisper_asr_segments, WHISPER_ASR_WORKERS))
+
+def available_backends():
+    if not BACKENDS:
+        raise Exception("没有可用的语音识别服务，请设置 GROQ_API_KEY 或 WHISPER_ASR_API_URL")
+    return BACKENDS
+
+def probe_duration(audio_file):
+    result = subprocess.run([FFPROBE, '-v', 'error', '-show_entries', 'format=duration',
+                             '-of', 'default=noprint_wrappers=1:nokey=1', audio_file],
+                            capture_output=True, text=True, check=True)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        raise Exception(f"无法获取音频时长: {audio_file}")
+
+def detect_silences(audio_file, noise='-30dB', duration=0.5):
+    """
+    Return (audio duration, [(silence_start, silence_end)]) from one ffmpeg silencedetect pass.
+    """
+    result = subprocess.run([FFMPEG, '-hide_banner', '-nostats', '-i', audio_file, '-vn',
+                             '-af', f'silencedetect=noise={noise}:d={duration}', '-f', 'null', '-'],
+                            capture_output=True, text=True, check=True)
+    match = re.search(r'Duration: (\d+):(\d+):(\d+\.?\d*)', result.stderr)
+    # containers without a duration in the header print Duration: N/A
+    total = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3)) if match else probe_duration(audio_file)
+    starts = [float(value) for value in re.findall(r'silence_start: (-?\d+\.?\d*)', result.stderr)]
+    ends = [float(value) for value in re.findall(r'silence_end: (\d+\.?\d*)', result.stderr)]
+    # a silence running to the end of the file has no silence_end
+    ends += [total] * (len(starts) - len(ends))
+    return total, list(zip(starts, ends))
+
+def plan_chunks(total, silences, chunk_seconds=TRANSCRIBE_CHUNK_SECONDS, overlap=TRANSCRIBE_CHUNK_OVERLAP,
+                window=TRANSCRIBE_SILENCE_WINDOW):
+    """
+    Cut roughly every chunk_seconds, moving each cut to the middle of the nearest silence within the window.
+    """
+    cuts = [0.0]
+    while total - cuts[-1] > chunk_seconds:
+        target = cuts[-1] + chunk_seconds
+        candidates = [(start + end) / 2 for start, end in silences
+                      if abs((start + end) / 2 - target) <= window and (start + end) / 2 > cuts[-1] + overlap]
+        cuts.append(min(candidates, key=lambda cut: abs(cut - target)) if candidates else target)
+    cuts.append(total)
+    return [Chunk(i, max(cut_start - overlap, 0), min(cut_end + overlap, total), cut_start, cut_end)
+            for i, (cut_start, cut_end) in enumerate(zip(cuts, cuts[1:]))]
+
+def extract_chunk(audio_file, chunk, directory):
+    # mono 16kHz mp3 is what whisper works with anyway, and keeps ten minutes around 5MB
+    chunk.path = os.path.join(directory, f'chunk{chunk.index:04d}.mp3')
+    subprocess.run([FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', '-ss', str(chunk.start), '-t', str(chunk.end - chunk.start),
+                    '-i', audio_file, '-vn', '-ac', '1', '-ar', '16000', '-b:a', '64k', chunk.path], check=True)
+    return chunk
+
+def transcribe_chunk(chunk, backends, language=None):
+    """
+    Run the chunk on whichever backend has a free slot, falling back to the others on failure.
+    """
+    candidates = [backend for backend in backends if backend.accepts(chunk.path)]
+    if not candidates:
+        raise Exception(f"分段 {chunk.index} 超出所有语音识别服务的文件大小限制")
+    # the pool runs at most as many chunks as there are slots, so one is always free here
+    backend = next((backend for backend in candidates if backend.slots.acquire(blocking=False)), None)
+    if backend is None:
+        backend = candidates[0]
+        backend.slots.acquire()
+    order = [backend] + [other for other in candidates if other is not backend]
+    errors = []
+    for i, backend in enumerate(order):
+        if i > 0:
+            backend.slots.acquire()
+        try:
+            segments = backend.transcribe(chunk.path, language)
+            print(f"分段 {chunk.index} 识别完成 ({backend.name})")
+            return [(chunk.start + start, chunk.start + end, text.strip()) for start, end, text in segments]
+        except Exception as e:
+            print(f"分段 {chunk.index} 识别失败 ({backend.name}): {e}")
+            errors.append(f"{backend.name}: {e}")
+        finally:
+            backend.slots.release()
+    raise Exception(f"分段 {chunk.index} 识别失败: {'; '.join(errors)}")
+
+def normalize(text):
+    return re.sub(r'\W+', '', text).lower()
+
+def stitch_segments(chunks, results):
+    """
+    Keep each segment in the chunk owning its midpoint, so overlapping audio is transcribed once, and drop a
+    repeated line straddling a cut.
+    """
+    segments = []
+    for chunk, chunk_segments in zip(chunks, results):
+        last = chunk is chunks[-1]
+        for start, end, text in chunk_segments:
+            middle = (start + end) / 2
+            if not text or middle < chunk.cut_start or (middle >= chunk.cut_end and not last):
+                continue
+            if segments and normalize(segments[-1][2]) == normalize(text) and start - segments[-1][1] < TRANSCRIBE_CHUNK_OVERLAP:
+                continue
+            segments.append((start, end, text))
+    return segments
+
+def format_timestamp(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+def write_transcript(segments, out_file, output='txt'):
+    with open(out_file, "w", encoding="utf-8") as f:
+        if output == 'srt':
+            for i, (start, end, text) in enumerate(segments, 1):
+                f.write(f"{i}\n{format_timestamp(start)} --> {format_timestamp(end)}\n{text}\n\n")
+        else:
+            f.write("\n".join(text for _, _, text in segments))
+
+def transcribe(audio_file, language=None, output='txt'):
+    """
+    Transcribe audio of any length: split it on silences into overlapping chunks, transcribe the chunks
+    concurrently on every configured backend and stitch the segments back on one timeline.
+    """
+    backends = available_backends()
+    total, silences = detect_silences(audio_file)
+    chunks = plan_chunks(total, silences)
+    print(f"语音识别: {audio_file}, {total:.0f}秒, {len(chunks)}个分段, 使用 {', '.join(backend.name for backend in backends)}")
+    directory = tempfile.mkdtemp(prefix='transcribe-')
+    try:
+        workers = sum(backend.workers for backend in backends)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(lambda chunk: extract_chunk(audio_file, chunk, directory), chunks))
+            results = list(executor.map(lambda chunk: transcribe_chunk(chunk, backends, language), chunks))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    out_file = f"{os.path.splitext(audio_file)[0]}.{output}"
+    write_transcript(stitch_segments(chunks, results), out_file, output)
+    print(f"已识别字幕: {out_file}")
+    return out_file